@@ -1,17 +1,81 @@
-from datetime import datetime
-from dateutil.parser import *
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import chain, islice, repeat
+from time import perf_counter
+import contextlib
+import csv
+import hashlib
+import heapq
+import io
 import json
+import math
+import mmap
 import os
+import random
 import re
+import struct
 import sys
+import tempfile
+import threading
+import urllib.parse
+
+# asyncio, concurrent.futures, multiprocessing, cProfile/pstats, zoneinfo and dateutil are slow to import and only some
+# modes need them, so they are imported where they are used ('python -X importtime FindRestaurants.py test' shows what
+# startup still pays for)
+
+try:
+    import resource  # only used for the peak memory measurement of the benchmarks
+except ImportError:  # not available on Windows
+    resource = None
 
 g_ERR_OK = 0  # error-level of 0 means no error
+g_ERR_BAD_ARGS = 2  # error-level for missing or invalid command-line arguments
 
 g_restaurants_filename = 'rest_hours.json'
 g_script_folder_path = os.path.dirname(os.path.abspath(__file__))
 g_restaurants_file_path = os.path.join(g_script_folder_path, g_restaurants_filename)
+g_snapshot_filename = 'rest_hours.snapshot'
+g_snapshot_file_path = os.path.join(g_script_folder_path, g_snapshot_filename)
+
+g_json_lines_extensions = ('.jsonl', '.ndjson')  # restaurant files with one JSON object per line
+g_read_chunk_size = 64 * 1024  # characters read at a time when streaming a restaurant file
+
+g_export_filename = 'rest_hours.csv'
+g_export_columns = ('name', 'timezone', 'day', 'start_minute', 'end_minute', 'schedule', 'warnings')
+g_write_buffer_size = 1024 * 1024  # bytes buffered before each write to an export file
+
+g_schedule_cache_size = 4096  # distinct (normalized) schedule strings whose parsed intervals are kept
+
+g_serve_host = '127.0.0.1'
+g_serve_port = 8080
+g_max_request_body_bytes = 16 * 1024 * 1024
+
+g_reload_poll_seconds = 2.0  # how often a running service checks the restaurant file for changes
+
+g_bench_venue_counts = (10 ** 3, 10 ** 4, 10 ** 5)  # default sizes; pass others (up to 10 ** 7) on the command line
+g_bench_query_count = 1000
+g_bench_seed = 20230203
+g_bench_output_filename = 'bench_results.json'
+
+g_parallel_chunk_records = 10000  # restaurants parsed per task by the parallel loader
+
+g_closing_soon_minutes = 60  # the interactive program notes restaurants that close within this many minutes
+
+g_result_cache_size = 512  # segments whose sorted query results each index keeps
+
+g_import_time_budget_seconds = 0.25  # wall time allowed for a fresh interpreter to import this module (see run_tests)
+
+g_metrics = None  # the MetricsRegistry recording instrumented events, or None when instrumentation is disabled
+g_profile = False  # set by the --profile command-line flag
+g_profile_report_filename = 'profile_report.txt'
+g_profile_lines = 40  # functions listed in the profile report
 
 g_days_of_week = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+g_minutes_per_day = 24 * 60
+g_minutes_per_week = len(g_days_of_week) * g_minutes_per_day  # week-minutes count from Monday 00:00 (0..10079)
 
 
 # ============================== File functions
@@ -20,17 +84,232 @@ g_days_of_week = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
 def read_restaurant_schedules(restaurant_file_path):
     with open(restaurant_file_path) as restaurant_file:
         restaurant_data = json.load(restaurant_file)
-    restaurants = [Restaurant(r['name'], r['times']) for r in restaurant_data]
+    restaurants = [Restaurant(r['name'], r['times'], r.get('timezone')) for r in restaurant_data]
 
     # show any parsing errors (skipped schedules for the given restaurant)
     for r in restaurants:
-        if r.log_messages:
-            log_strings = '\n\t'.join(r.log_messages)
-            print(f'{r.name}:\n\t{log_strings}')
+        show_log_messages(r.name, r.log_messages)
 
     return restaurants
 
 
+g_whitespace_regex = re.compile(r'\s*')
+g_number_tail_regex = re.compile(r'[0-9.eE+-]*\Z')  # the rest of a number cut off at the end of the buffer
+
+
+def iterate_json_array(json_file, chunk_size=g_read_chunk_size):
+    # yield the elements of a top-level JSON array one at a time, reading the file in chunks instead of loading the
+    # whole document (only the current chunk and element are in memory)
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    at_eof = False
+    need_more = False
+    state = 'start'  # start: expect '['; first: expect an element or ']'; element: expect an element; next: ',' or ']'
+    while True:
+        if need_more:
+            chunk = json_file.read(chunk_size)
+            buffer = buffer[position:] + chunk
+            position = 0
+            at_eof = not chunk
+            need_more = False
+
+        position = g_whitespace_regex.match(buffer, position).end()
+        if position == len(buffer):
+            if at_eof:
+                raise ValueError('Unexpected end of file in JSON array')
+            need_more = True
+            continue
+
+        char = buffer[position]
+        if state == 'start':
+            if char != '[':
+                raise ValueError(f'Expected a JSON array, found "{char}"')
+            position += 1
+            state = 'first'
+        elif state == 'next' or (state == 'first' and char == ']'):
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f'Expected "," or "]" in JSON array, found "{char}"')
+            position += 1
+            state = 'element'
+        else:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if at_eof:
+                    raise
+                need_more = True  # the element continues in the next chunk
+                continue
+            if not at_eof and isinstance(element, (int, float)) and not isinstance(element, bool) and \
+                    g_number_tail_regex.match(buffer, end):
+                need_more = True  # a number at the end of the buffer (such as "1" of "1e5") might continue
+                continue
+            position = end
+            state = 'next'
+            yield element
+
+
+def iterate_restaurant_records(restaurant_file, json_lines):
+    if json_lines:
+        for line in restaurant_file:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield from iterate_json_array(restaurant_file)
+
+
+ParseWarning = namedtuple('ParseWarning', ('restaurant_id', 'name', 'message'))
+
+
+def print_parse_warning(parse_warning):
+    print(f'{parse_warning.name}:\n\t{parse_warning.message}')
+
+
+def write_parse_warning_to_stderr(parse_warning):
+    print(json.dumps(parse_warning._asdict()), file=sys.stderr)
+
+
+def iterate_restaurants(restaurant_file_path, warning_sink=None):
+    # yield restaurants as the file is read (a JSON array, or JSON Lines for .jsonl/.ndjson files); any parsing
+    # warnings are passed to warning_sink (a callable taking a ParseWarning) rather than printed
+    json_lines = restaurant_file_path.endswith(g_json_lines_extensions)
+    with open(restaurant_file_path) as restaurant_file:
+        for restaurant_id, record in enumerate(iterate_restaurant_records(restaurant_file, json_lines)):
+            restaurant = Restaurant(record['name'], record['times'], record.get('timezone'))
+            if warning_sink is not None:
+                for message in restaurant.log_messages:
+                    warning_sink(ParseWarning(restaurant_id, restaurant.name, message))
+            yield restaurant
+
+
+def stream_restaurant_store(restaurant_file_path, warning_sink=None):
+    # load a RestaurantStore without ever holding the whole JSON document or all the Restaurant objects
+    store = RestaurantStore()
+    for restaurant in iterate_restaurants(restaurant_file_path, warning_sink):
+        store.append_parsed(restaurant.name, restaurant.log_messages, restaurant.open_intervals, restaurant.timezone)
+    return store
+
+
+def parse_restaurant_chunk(records):
+    # runs in a worker process: parses a chunk of (name, times, timezone) records and returns compact columns (names,
+    # interval counts, starts, ends, and log messages and time zones by position in the chunk) instead of pickled
+    # Restaurant objects
+    names = []
+    interval_counts = array('I')
+    starts = array('H')
+    ends = array('H')
+    log_messages = {}
+    timezones = {}
+    for chunk_position, (name, schedule_strings, timezone) in enumerate(records):
+        messages = []
+        intervals = map_schedules_to_intervals(schedule_strings, messages)
+        timezone = check_timezone(timezone, messages)
+        names.append(name)
+        interval_counts.append(len(intervals))
+        for start, end in intervals:
+            starts.append(start)
+            ends.append(end)
+        if messages:
+            log_messages[chunk_position] = messages
+        if timezone is not None:
+            timezones[chunk_position] = timezone
+    return names, interval_counts, starts, ends, log_messages, timezones
+
+
+def merge_restaurant_chunk(store, parsed_chunk, warning_sink):
+    names, interval_counts, starts, ends, log_messages, timezones = parsed_chunk
+    first_restaurant_id = len(store)
+    store.extend_columns(names, interval_counts, starts, ends, log_messages, timezones)
+    if warning_sink is not None:
+        for chunk_position in sorted(log_messages):
+            for message in log_messages[chunk_position]:
+                warning_sink(ParseWarning(first_restaurant_id + chunk_position, names[chunk_position], message))
+
+
+def parallel_restaurant_store(restaurant_file_path, warning_sink=None, workers=None,
+                              chunk_records=g_parallel_chunk_records):
+    # Same result as stream_restaurant_store (including the order of the warnings), but the schedules are parsed by a
+    # pool of worker processes. The file is still read here, a chunk of records at a time; chunks are merged in file
+    # order, and only a few per worker are in flight at once, so memory stays bounded.
+    workers = workers or os.cpu_count() or 1
+    json_lines = restaurant_file_path.endswith(g_json_lines_extensions)
+    store = RestaurantStore()
+    pending_chunks = deque()
+    from concurrent.futures import ProcessPoolExecutor  # slow to import, so only when loading in parallel
+    with open(restaurant_file_path) as restaurant_file, ProcessPoolExecutor(workers) as executor:
+        records = ((r['name'], r['times'], r.get('timezone'))
+                   for r in iterate_restaurant_records(restaurant_file, json_lines))
+        while True:
+            chunk = list(islice(records, chunk_records))
+            if not chunk:
+                break
+            pending_chunks.append(executor.submit(parse_restaurant_chunk, chunk))
+            if len(pending_chunks) >= 2 * workers:
+                merge_restaurant_chunk(store, pending_chunks.popleft().result(), warning_sink)
+        while pending_chunks:
+            merge_restaurant_chunk(store, pending_chunks.popleft().result(), warning_sink)
+    return store
+
+
+def read_datetimes(datetimes_file_path):
+    # one date and time per line (same formats as the interactive prompt); blank lines are ignored
+    datetime_objects = []
+    with open(datetimes_file_path) as datetimes_file:
+        for line_number, line in enumerate(datetimes_file, 1):
+            datetime_string = line.strip()
+            if not datetime_string:
+                continue
+            try:
+                datetime_objects.append(parse_datetime(datetime_string))
+            except (ValueError, OverflowError):
+                print(f'Warning: Could not parse date/time string "{datetime_string}" on line {line_number}. Skipped.')
+    return datetime_objects
+
+
+def iterate_day_intervals(open_intervals):
+    # (day, start day-minute, end day-minute) for the part of each week-minute interval on each day it covers
+    for start, end in open_intervals:
+        while start < end:
+            day, day_start = divmod(start, g_minutes_per_day)
+            yield day, day_start, min(end - day * g_minutes_per_day, g_minutes_per_day)
+            start = (day + 1) * g_minutes_per_day
+
+
+def get_export_rows(restaurant):
+    # one row (see g_export_columns) per open interval per day, with the schedule strings that produced it; a
+    # restaurant that is never open still gets a row (without a day), so its schedules and warnings are not lost. The
+    # schedule column is empty for restaurants from a RestaurantStore, which doesn't keep the schedule strings
+    timezone = restaurant.timezone or ''
+    warnings = ' | '.join(restaurant.log_messages)
+    schedule_strings = restaurant.schedule_strings or ()
+    sources = [(interval, schedule_string) for schedule_string in schedule_strings
+               for interval in parse_schedule_intervals(schedule_string, [])]
+    rows = []
+    for day, start, end in iterate_day_intervals(restaurant.open_intervals):
+        week_start = day * g_minutes_per_day + start
+        week_end = day * g_minutes_per_day + end
+        schedule = '; '.join(dict.fromkeys(schedule_string for (source_start, source_end), schedule_string in sources
+                                           if source_start < week_end and week_start < source_end))
+        rows.append((restaurant.name, timezone, g_days_of_week[day], start, end, schedule, warnings))
+    if not rows:
+        rows.append((restaurant.name, timezone, '', '', '', '; '.join(schedule_strings), warnings))
+    return rows
+
+
+def export_restaurant_intervals(restaurant_file_path, export_file):
+    # write the parsed schedules as CSV, streaming the restaurant file (only one restaurant is in memory at a time);
+    # returns the number of restaurants written
+    writer = csv.writer(export_file)
+    writer.writerow(g_export_columns)
+    restaurant_count = 0
+    for restaurant in iterate_restaurants(restaurant_file_path):
+        writer.writerows(get_export_rows(restaurant))
+        restaurant_count += 1
+    return restaurant_count
+
+
 # ============================== User interaction functions
 
 
@@ -44,29 +323,215 @@ def prompt_for_date_and_time():
 
         try:
             # Note: The parser defaults most segments that are omitted (year, month, day, minutes)
-            target_datetime = parse(target_datetime_string)
+            target_datetime = parse_datetime(target_datetime_string)
             print(f'\tUsing time: {datetime.strftime(target_datetime, "%Y-%m-%d %I:%M %p (%a)")}')
             return target_datetime
-        except ParserError:
+        except (ValueError, OverflowError):
             print(f'\tCould not parse date/time string "{target_datetime_string}". Please re-enter.')
             continue
 
 
-def show_open_restaurant_names(open_restaurants, dow, time):
-    names = [r.name for r in open_restaurants]
-    names.sort()
-    names_string = '\n\t'.join(names)  # todo: enhancement: also show how many minutes till close (if <= 60 min)
+def show_log_messages(name, log_messages):
+    if log_messages:
+        log_strings = '\n\t'.join(log_messages)
+        print(f'{name}:\n\t{log_strings}')
+
+
+def show_open_restaurant_names(open_restaurants, datetime_object):
+    # the restaurants come sorted by name (see ShardedRestaurantIndex.get_open_restaurants_by_name_at)
+    dow, time = transform_datetime_to_dow_and_time(datetime_object)
+    names = []
+    for r in open_restaurants:
+        closing_minutes = minutes_until_close(r, datetime_object)
+        if closing_minutes is not None and closing_minutes <= g_closing_soon_minutes:
+            names.append(f'{r.name} (closes in {closing_minutes} min)')
+        else:
+            names.append(r.name)
+    names_string = '\n\t'.join(names)
     print(f'{len(names)} restaurants are open on "{dow}" at "{time}" (24-hr time):\n\t{names_string}')
 
 
+def show_batch_results(datetime_objects, results):
+    # one tab-separated line per date and time: the date and time, the number of open restaurants, then their names
+    # (the results are name-sorted, see get_open_names_for_datetimes)
+    for datetime_object, names in zip(datetime_objects, results):
+        names = list(names)
+        print('\t'.join([datetime_object.isoformat(sep=' ', timespec='minutes'), str(len(names))] + names))
+
+
+# ============================== Instrumentation functions
+
+
+g_latency_bucket_bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+g_metrics_bucket_bounds = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005) + g_latency_bucket_bounds
+
+
+class LatencyHistogram:
+    # counts of durations (in seconds) in fixed buckets; the last bucket holds anything over the largest bound
+    def __init__(self, bucket_bounds=g_latency_bucket_bounds):
+        self.bucket_bounds = bucket_bounds
+        self.bucket_counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.bucket_counts[bisect_left(self.bucket_bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def get_percentile(self, fraction):
+        # upper bound of the bucket holding the given fraction of the durations (the max, for the last bucket)
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        running_count = 0
+        for bound, bucket_count in zip(self.bucket_bounds, self.bucket_counts):
+            running_count += bucket_count
+            if running_count >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'p50_ms': self.get_percentile(0.5) * 1000,
+                'p99_ms': self.get_percentile(0.99) * 1000,
+                'max_ms': self.max * 1000,
+                'buckets_ms': {f'{bound * 1000:g}': bucket_count
+                               for bound, bucket_count in zip(self.bucket_bounds, self.bucket_counts)},
+                'over_ms': self.bucket_counts[-1]}
+
+
+class MetricsRegistry:
+    # Counters and duration histograms recorded by the instrumented hot paths (parsing and queries), plus optional
+    # listeners called with (name, value) for every event. Instrumentation is off (a single None check in each hot
+    # path) unless a registry is enabled with enable_metrics.
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+        for listener in self.listeners:
+            listener(name, amount)
+
+    def record(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = LatencyHistogram(g_metrics_bucket_bounds)
+        self.histograms[name].record(seconds)
+        for listener in self.listeners:
+            listener(name, seconds)
+
+    def to_dict(self):
+        return {'counters': dict(sorted(self.counters.items())),
+                'histograms': {name: self.histograms[name].to_dict() for name in sorted(self.histograms)}}
+
+
+def enable_metrics(metrics_registry=None):
+    global g_metrics
+    g_metrics = metrics_registry if metrics_registry is not None else MetricsRegistry()
+    return g_metrics
+
+
+def disable_metrics():
+    global g_metrics
+    g_metrics = None
+
+
+def run_profiled(function, *args):
+    # run the function under cProfile with metrics enabled, then write both reports to g_profile_report_filename
+    import cProfile
+    import pstats
+    metrics_registry = enable_metrics()
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        disable_metrics()
+        profile_report_file_path = os.path.join(os.getcwd(), g_profile_report_filename)
+        with open(profile_report_file_path, 'w') as profile_report_file:
+            profile_report_file.write('========== Metrics\n')
+            profile_report_file.write(json.dumps(metrics_registry.to_dict(), indent=2))
+            profile_report_file.write('\n\n========== Profile (by cumulative time)\n')
+            pstats.Stats(profiler, stream=profile_report_file).sort_stats('cumulative').print_stats(g_profile_lines)
+        print(f'Profile report written to "{profile_report_file_path}".', file=sys.stderr)
+
+
 # ============================== Backend functions
 
 
+# Internally, times are integer minutes: a day-minute counts from midnight (0..1440, where 1440 is midnight at the END of
+# the day) and a week-minute counts from Monday 00:00 (0..10080). The 'HHMM' strings and 'Mon'..'Sun' day names of the
+# original model are only produced or accepted at the edges (display, and the compatibility functions below).
+
+
+def format_day_minute(day_minute):
+    return f'{day_minute // 60:02}{day_minute % 60:02}'
+
+
+def format_week_minute(week_minute):
+    day, day_minute = divmod(week_minute, g_minutes_per_day)
+    return g_days_of_week[day], format_day_minute(day_minute)
+
+
+def get_week_minute(dow, time):
+    return g_days_of_week.index(dow) * g_minutes_per_day + int(time[:2]) * 60 + int(time[2:])
+
+
+def transform_datetime_to_week_minute(datetime_object):
+    return datetime_object.weekday() * g_minutes_per_day + datetime_object.hour * 60 + datetime_object.minute
+
+
 def transform_datetime_to_dow_and_time(datetime_object):
-    dow = datetime.strftime(datetime_object, '%a')
-    hr = datetime.strftime(datetime_object, '%H')
-    minute = datetime.strftime(datetime_object, '%M')
-    return dow, f'{hr}{minute}'
+    return format_week_minute(transform_datetime_to_week_minute(datetime_object))
+
+
+@lru_cache(maxsize=None)
+def get_time_zone(timezone):
+    # the ZoneInfo for an IANA time zone name (e.g. 'America/Denver'), or None if there is no such zone
+    import zoneinfo
+    try:
+        return zoneinfo.ZoneInfo(timezone)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def check_timezone(timezone, log_messages):
+    # a restaurant's time zone name if it is known, otherwise None (with a warning if one was given); a restaurant
+    # without a time zone keeps the original model, where its times are local to whoever asks
+    if timezone is None:
+        return None
+    if not isinstance(timezone, str) or get_time_zone(timezone) is None:
+        log_messages.append(f'Warning: Unknown time zone "{timezone}". Its times are taken as local to each query.')
+        return None
+    return timezone
+
+
+def transform_datetime_to_timezone(datetime_object, timezone):
+    # the wall-clock date and time in the given zone; a naive date and time (or no zone) is taken as already local
+    if timezone is None or datetime_object.tzinfo is None:
+        return datetime_object
+    return datetime_object.astimezone(get_time_zone(timezone))
+
+
+def parse_datetime(datetime_string):
+    # ISO 8601 (what the service and batch files normally carry) needs no dateutil; anything else goes to dateutil's
+    # free-form parser, imported on first use. Both raise ValueError (or OverflowError) for unparseable input, and
+    # anything but a string is a TypeError (as dateutil raises)
+    if not isinstance(datetime_string, str):
+        raise TypeError(f'Expected a date and time string, found {type(datetime_string).__name__}')
+    try:
+        return datetime.fromisoformat(datetime_string.strip())
+    except ValueError:
+        pass
+    from dateutil.parser import parse
+    return parse(datetime_string)
 
 
 def enumerate_days_of_week(start_dow, opt_end_dow):
@@ -85,33 +550,46 @@ def enumerate_days_of_week(start_dow, opt_end_dow):
     return dows
 
 
-def get_time_range(start_time, end_time):
-    if start_time is None or end_time is None or start_time == end_time:
+def get_day_minute(hr, minute, ampm):
+    return (int(hr) % 12 + (12 if ampm == 'pm' else 0)) * 60 + int(minute)
+
+
+def get_minute_range(start_minute, end_minute):
+    if start_minute is None or end_minute is None or start_minute == end_minute:
         return []
-    start = f'{start_time.hour:02}{start_time.minute:02}'
-    end = f'{end_time.hour:02}{end_time.minute:02}'
-    if end == '0000':
-        end = '2400'  # convert midnight at BEGINNING of the day to midnight at the END of the day
-    return start, end
+    if end_minute == 0:
+        end_minute = g_minutes_per_day  # convert midnight at BEGINNING of the day to midnight at the END of the day
+    return start_minute, end_minute
 
 
-def get_time_ranges(start_hr, start_min, start_ampm, end_hr, end_min, end_ampm):
-    # parse the start and end times
-    time_format = '%I:%M %p'
-    start_time = datetime.strptime(f'{start_hr}:{start_min} {start_ampm}', time_format)
-    end_time = datetime.strptime(f'{end_hr}:{end_min} {end_ampm}', time_format)
-    next_day_start_time = None
-    next_day_end_time = None
+def get_minute_ranges(start_hr, start_min, start_ampm, end_hr, end_min, end_ampm):
+    start_minute = get_day_minute(start_hr, start_min, start_ampm)
+    end_minute = get_day_minute(end_hr, end_min, end_ampm)
+    next_day_start_minute = None
+    next_day_end_minute = None
 
     # check for times that wrap around the date boundary (midnight)
-    if end_time < start_time:  # time range wrapped to the next day
-        day_boundary = datetime.strptime('12:00 am', time_format)
-        next_day_start_time = day_boundary
-        next_day_end_time = end_time
-        end_time = day_boundary
-
-    times = get_time_range(start_time, end_time)
-    next_day_times = get_time_range(next_day_start_time, next_day_end_time)
+    if end_minute < start_minute:  # time range wrapped to the next day
+        next_day_start_minute = 0
+        next_day_end_minute = end_minute
+        end_minute = 0
+
+    minutes = get_minute_range(start_minute, end_minute)
+    next_day_minutes = get_minute_range(next_day_start_minute, next_day_end_minute)
+    return minutes, next_day_minutes
+
+
+def get_time_range(start_time, end_time):
+    if start_time is None or end_time is None:
+        return []
+    minutes = get_minute_range(start_time.hour * 60 + start_time.minute, end_time.hour * 60 + end_time.minute)
+    return tuple(format_day_minute(m) for m in minutes) if minutes else []
+
+
+def get_time_ranges(start_hr, start_min, start_ampm, end_hr, end_min, end_ampm):
+    minutes, next_day_minutes = get_minute_ranges(start_hr, start_min, start_ampm, end_hr, end_min, end_ampm)
+    times = tuple(format_day_minute(m) for m in minutes) if minutes else []
+    next_day_times = tuple(format_day_minute(m) for m in next_day_minutes) if next_day_minutes else []
     return times, next_day_times
 
 
@@ -128,50 +606,115 @@ def augment_map(mapping, key, values):
     mapping[key].append(values)
 
 
-def parse_schedule(schedule_string, log_messages):
-    if not schedule_string:
-        return {}
-
-    # define regular expressions that represent schedules (for parsing)
-    hyphen = r'\s*-\s*'
-
-    hr = r'(1|2|3|4|5|6|7|8|9|10|11|12|01|02|03|04|05|06|07|08|09)'
-    minute = r'(:(00|30))?'
-    ampm = r'\s*(am|pm)'
-    time = fr'{hr}{minute}{ampm}'
-    time_range = fr'{time}{hyphen}{time}'
-
-    dow = r'(Mon|Tue|Wed|Thu|Fri|Sat|Sun)'
-    dow_range = fr'{dow}({hyphen}{dow})?'
-    dow_ranges = fr'{dow_range}(,\s*{dow_range})?'  # support ONE OR TWO day ranges (separated by commas)
-
-    schedule = fr'{dow_ranges}\s+{time_range}'
-
-    # matching groups (one-origin):
-    #   start_dow
-    #   optional hyphen and end_dow
-    #   end_dow (optional)
-    #   optional comma and additional dow range
-    #   start_dow2 (optional)
-    #   optional hyphen and end_dow2
-    #   end_dow2 (optional)
-    #   start_hr
-    #   optional colon and minute
-    #   start_min (optional)
-    #   start_ampm
-    #   end_hr
-    #   optional colon and minute
-    #   end_min (optional)
-    #   end_ampm
-
-    # Note: if the start_ampm is "am" and the end_ampm is "pm", that's fine (still in the same day), but if the start
-    # is "pm" and the end is "am", then create TWO ranges of time (one for each separate day)
-
-    match = re.match(schedule, schedule_string)
+def merge_intervals(intervals):
+    # sort (start, end) intervals and combine any that overlap or touch, so each minute is covered at most once
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def normalize_window(start_week_minute, end_week_minute):
+    # A window runs from its start up to (not including) its end. An end past the end of the week continues into the
+    # next week, as does an end at or before the start (so equal start and end mean a whole week); windows longer than
+    # a week are cut to one week. Returns (start, end) with 0 <= start < week and start < end <= start + week.
+    start = start_week_minute % g_minutes_per_week
+    length = end_week_minute - start_week_minute
+    if length <= 0:
+        length = length % g_minutes_per_week or g_minutes_per_week
+    return start, start + min(length, g_minutes_per_week)
+
+
+def get_transitions(open_intervals):
+    # the sorted week-minutes at which a restaurant opens, and those at which it closes; the end of the week is not a
+    # transition for a restaurant that is open through Sunday midnight into Monday
+    openings = [start for start, end in open_intervals]
+    closings = [end for start, end in open_intervals]
+    if openings and openings[0] == 0 and closings[-1] == g_minutes_per_week:
+        openings.pop(0)
+        closings.pop()
+    return openings, closings
+
+
+def get_minutes_until_next(transition_minutes, week_minute):
+    # minutes from the given week-minute to the next of the (sorted) transitions after it, wrapping around the end
+    # of the week; None if there are no transitions
+    if not transition_minutes:
+        return None
+    i = bisect_right(transition_minutes, week_minute)
+    next_week_minute = transition_minutes[i] if i < len(transition_minutes) \
+        else transition_minutes[0] + g_minutes_per_week
+    return next_week_minute - week_minute
+
+
+def get_days_to_times(intervals):
+    # group week-minute intervals by day-of-week as 'HHMM' string ranges (splitting any range that crosses midnight)
+    days_to_times = {}
+    for start, end in intervals:
+        while start < end:
+            day = start // g_minutes_per_day
+            day_start = day * g_minutes_per_day
+            day_end = min(end, day_start + g_minutes_per_day)
+            augment_map(days_to_times, g_days_of_week[day],
+                        (format_day_minute(start - day_start), format_day_minute(day_end - day_start)))
+            start = day_end
+    return days_to_times
+
+
+# define regular expressions that represent schedules (for parsing); compiled once, when the module is loaded
+g_hyphen = r'\s*-\s*'
+
+g_hr = r'(1|2|3|4|5|6|7|8|9|10|11|12|01|02|03|04|05|06|07|08|09)'
+g_minute = r'(:(00|30))?'
+g_ampm = r'\s*(am|pm)'
+g_time = fr'{g_hr}{g_minute}{g_ampm}'
+g_time_range = fr'{g_time}{g_hyphen}{g_time}'
+
+g_dow = r'(Mon|Tue|Wed|Thu|Fri|Sat|Sun)'
+g_dow_range = fr'{g_dow}({g_hyphen}{g_dow})?'
+g_dow_ranges = fr'{g_dow_range}(,\s*{g_dow_range})?'  # support ONE OR TWO day ranges (separated by commas)
+
+g_schedule_regex = re.compile(fr'{g_dow_ranges}\s+{g_time_range}')
+
+# matching groups (one-origin):
+#   start_dow
+#   optional hyphen and end_dow
+#   end_dow (optional)
+#   optional comma and additional dow range
+#   start_dow2 (optional)
+#   optional hyphen and end_dow2
+#   end_dow2 (optional)
+#   start_hr
+#   optional colon and minute
+#   start_min (optional)
+#   start_ampm
+#   end_hr
+#   optional colon and minute
+#   end_min (optional)
+#   end_ampm
+
+# Note: if the start_ampm is "am" and the end_ampm is "pm", that's fine (still in the same day), but if the start
+# is "pm" and the end is "am", then create TWO ranges of time (one for each separate day)
+
+g_whitespace_run_regex = re.compile(r'\s+')
+
+
+def normalize_schedule_string(schedule_string):
+    # the grammar treats any run of whitespace like a single space, so this doesn't change what matches
+    return g_whitespace_run_regex.sub(' ', schedule_string)
+
+
+@lru_cache(maxsize=g_schedule_cache_size)
+def parse_normalized_schedule(normalized_schedule_string):
+    # Many restaurants share the same schedule strings, so parsed results are cached (keyed on the normalized string).
+    # Returns an immutable tuple of intervals, or None if the string doesn't match the grammar.
+    match = g_schedule_regex.match(normalized_schedule_string)
     if match is None:
-        log_messages.append(f'Warning: Unexpected format for schedule "{schedule_string}". '
-                            'Please fix the data or the regular expressions for parsing the data.')
-        return {}
+        return None
 
     start_dow, opt_hyphen, opt_end_dow, \
         opt_comma, \
@@ -183,18 +726,46 @@ def parse_schedule(schedule_string, log_messages):
         start_min = '00'
     if not end_min:
         end_min = '00'
-    times, next_day_times = get_time_ranges(start_hr, start_min, start_ampm, end_hr, end_min, end_ampm)
+    minutes, next_day_minutes = get_minute_ranges(start_hr, start_min, start_ampm, end_hr, end_min, end_ampm)
 
-    dow_to_times = {}   # mapping each day-of-week (key) to a list of open time ranges (open time, close time)
+    intervals = []  # open (start, end) week-minute ranges, none crossing midnight, in the order the days were listed
     dows = enumerate_days_of_week(start_dow, opt_end_dow)
     dows2 = enumerate_days_of_week(opt_start_dow2, opt_end_dow2)
     for dow in dows + dows2:
-        augment_map(dow_to_times, dow, times)
-        if next_day_times:
-            next_dow = get_next_dow(dow)
-            augment_map(dow_to_times, next_dow, next_day_times)
+        day_start = g_days_of_week.index(dow) * g_minutes_per_day
+        if minutes:
+            intervals.append((day_start + minutes[0], day_start + minutes[1]))
+        if next_day_minutes:
+            next_day_start = (day_start + g_minutes_per_day) % g_minutes_per_week
+            intervals.append((next_day_start + next_day_minutes[0], next_day_start + next_day_minutes[1]))
+
+    return tuple(intervals)
+
+
+def get_schedule_cache_info():
+    # hits, misses, maxsize and currsize of the parsed-schedule cache
+    return parse_normalized_schedule.cache_info()
+
 
-    return dow_to_times
+def parse_schedule_intervals(schedule_string, log_messages):
+    if not schedule_string:
+        return ()
+
+    started = perf_counter() if g_metrics is not None else 0.0
+    intervals = parse_normalized_schedule(normalize_schedule_string(schedule_string))
+    if g_metrics is not None:
+        g_metrics.record('parse.schedule_seconds', perf_counter() - started)
+        if intervals is None:
+            g_metrics.increment('parse.format_mismatches')
+    if intervals is None:
+        log_messages.append(f'Warning: Unexpected format for schedule "{schedule_string}". '
+                            'Please fix the data or the regular expressions for parsing the data.')
+        return ()
+    return intervals
+
+
+def parse_schedule(schedule_string, log_messages):
+    return get_days_to_times(parse_schedule_intervals(schedule_string, log_messages))
 
 
 def map_days_to_times(schedule_strings, log_messages):
@@ -208,52 +779,1142 @@ def map_days_to_times(schedule_strings, log_messages):
     return mapping
 
 
+def map_schedules_to_intervals(schedule_strings, log_messages):
+    intervals = []
+    for schedule_string in schedule_strings:
+        intervals.extend(parse_schedule_intervals(schedule_string, log_messages))
+    return merge_intervals(intervals)
+
+
 class Restaurant:
-    def __init__(self, name, schedule_strings):
+    # no __dict__
+    __slots__ = ('name', 'schedule_strings', 'log_messages', 'open_intervals', 'transitions', 'timezone')
+
+    def __init__(self, name, schedule_strings, timezone=None):
         self.name = name
         self.schedule_strings = schedule_strings
         self.log_messages = []
-        self.open_days_to_times = map_days_to_times(schedule_strings, self.log_messages)
+        self.open_intervals = map_schedules_to_intervals(schedule_strings, self.log_messages)  # sorted, merged
+        self.transitions = get_transitions(self.open_intervals)  # (openings, closings)
+        self.timezone = check_timezone(timezone, self.log_messages)  # IANA name, or None for local to each query
+
+    @classmethod
+    def from_parsed(cls, name, schedule_strings, log_messages, open_intervals, timezone=None):
+        # build a restaurant from already-parsed data (without parsing its schedules again)
+        restaurant = cls.__new__(cls)
+        restaurant.name = name
+        restaurant.schedule_strings = schedule_strings
+        restaurant.log_messages = log_messages
+        restaurant.open_intervals = open_intervals
+        restaurant.transitions = get_transitions(open_intervals)
+        restaurant.timezone = timezone
+        return restaurant
 
     def __str__(self):
-        desc = f'Restaurant "{self.name}" with schedule "{self.schedule_strings}"\n'
+        if self.schedule_strings is None:  # not kept (see RestaurantStore)
+            desc = f'Restaurant "{self.name}"\n'
+        else:
+            desc = f'Restaurant "{self.name}" with schedule "{self.schedule_strings}"\n'
+        if self.timezone is not None:
+            desc += f'Time zone: "{self.timezone}"\n'
         if self.log_messages:
             desc += f'Logs: "{self.log_messages}"\n'
         desc += 'Parsed schedule:\n'
-        for dow in self.open_days_to_times:
-            desc += f'\t{dow}: {self.open_days_to_times[dow]}\n'
+        days_to_times = get_days_to_times(self.open_intervals)
+        for dow in days_to_times:
+            desc += f'\t{dow}: {days_to_times[dow]}\n'
         return desc
 
+    def is_open_at(self, week_minute):
+        # find the last interval starting at or before the given minute ((minute, week end) sorts after any of them)
+        i = bisect_right(self.open_intervals, (week_minute, g_minutes_per_week)) - 1
+        return i >= 0 and week_minute < self.open_intervals[i][1]
+
+    def get_closing_week_minute(self, week_minute):
+        # None if closed at the given minute; otherwise when it next closes (past the end of the week if it is open
+        # through Sunday midnight into Monday), or math.inf if it never closes
+        i = bisect_right(self.open_intervals, (week_minute, g_minutes_per_week)) - 1
+        if i < 0 or week_minute >= self.open_intervals[i][1]:
+            return None
+        closing_week_minute = self.open_intervals[i][1]
+        if closing_week_minute == g_minutes_per_week and self.open_intervals[0][0] == 0:  # continues into Monday
+            if self.open_intervals[0][1] == g_minutes_per_week:
+                return math.inf
+            closing_week_minute += self.open_intervals[0][1]
+        return closing_week_minute
+
+    def is_open_between(self, start_week_minute, end_week_minute):
+        # open for the whole window (see normalize_window), across midnight and the end of the week
+        start, end = normalize_window(start_week_minute, end_week_minute)
+        closing_week_minute = self.get_closing_week_minute(start)
+        return closing_week_minute is not None and closing_week_minute >= end
+
+    def get_minutes_until_close(self, week_minute):
+        # None if closed at the given minute, math.inf if it never closes
+        if not self.is_open_at(week_minute):
+            return None
+        minutes = get_minutes_until_next(self.transitions[1], week_minute)
+        return math.inf if minutes is None else minutes
+
+    def get_minutes_until_open(self, week_minute):
+        # 0 if already open at the given minute, None if it never opens
+        if self.is_open_at(week_minute):
+            return 0
+        return get_minutes_until_next(self.transitions[0], week_minute)
+
     def is_open(self, dow, time):
-        if dow not in self.open_days_to_times.keys():
+        if time >= '2400':  # midnight at the END of a day was never an open time in the 'HHMM' model
             return False
-        for open_time, close_time in self.open_days_to_times[dow]:
-            if open_time <= time < close_time:
-                return True
-        return False
+        return self.is_open_at(get_week_minute(dow, time))
+
+
+def record_scan(started, restaurants):
+    g_metrics.record('query.scan_seconds', perf_counter() - started)
+    g_metrics.increment('query.restaurants_scanned', len(restaurants))
+
+
+def get_open_restaurants_at(restaurants, week_minute):
+    started = perf_counter() if g_metrics is not None else 0.0
+    open_restaurants = [r for r in restaurants if r.is_open_at(week_minute)]
+    if g_metrics is not None:
+        record_scan(started, restaurants)
+    return open_restaurants
 
 
 def get_open_restaurants(restaurants, dow, time):
+    started = perf_counter() if g_metrics is not None else 0.0
     open_restaurants = [r for r in restaurants if r.is_open(dow, time)]
+    if g_metrics is not None:
+        record_scan(started, restaurants)
     return open_restaurants
 
 
+def get_open_restaurants_between(restaurants, start_week_minute, end_week_minute):
+    open_restaurants = [r for r in restaurants if r.is_open_between(start_week_minute, end_week_minute)]
+    return open_restaurants
+
+
+def get_local_week_minute(restaurant, datetime_object):
+    return transform_datetime_to_week_minute(transform_datetime_to_timezone(datetime_object, restaurant.timezone))
+
+
+def minutes_until_close(restaurant, datetime_object):
+    # None if the restaurant is closed at that time, math.inf if it never closes
+    return restaurant.get_minutes_until_close(get_local_week_minute(restaurant, datetime_object))
+
+
+def get_next_open_datetime(datetime_object, minutes_until_open, timezone=None):
+    if minutes_until_open is None:
+        return None
+    if minutes_until_open == 0:
+        return datetime_object
+    # the minutes are on the restaurant's wall clock, so they are added there (its UTC offset may change meanwhile),
+    # and the result is given in the same zone as the date and time asked about
+    local_datetime_object = transform_datetime_to_timezone(datetime_object, timezone)
+    next_open_datetime = local_datetime_object.replace(second=0, microsecond=0) + timedelta(minutes=minutes_until_open)
+    if local_datetime_object is datetime_object:
+        return next_open_datetime
+    return next_open_datetime.astimezone(datetime_object.tzinfo)
+
+
+def next_open(restaurant, datetime_object):
+    # when the restaurant next opens: the given time itself if it is already open, None if it never opens
+    minutes_until_open = restaurant.get_minutes_until_open(get_local_week_minute(restaurant, datetime_object))
+    return get_next_open_datetime(datetime_object, minutes_until_open, restaurant.timezone)
+
+
+def get_next_changes(restaurants, datetime_object):
+    # for every restaurant: (restaurant, minutes until it closes or None if closed, when it next opens or None if it
+    # never opens), converting the date and time only once per time zone
+    week_minutes = {}  # time zone -> the date and time as a week-minute there
+    next_changes = []
+    for r in restaurants:
+        if r.timezone not in week_minutes:
+            week_minutes[r.timezone] = get_local_week_minute(r, datetime_object)
+        week_minute = week_minutes[r.timezone]
+        next_changes.append((r, r.get_minutes_until_close(week_minute),
+                             get_next_open_datetime(datetime_object, r.get_minutes_until_open(week_minute),
+                                                    r.timezone)))
+    return next_changes
+
+
+class RestaurantStore:
+    # Columnar alternative to a list of Restaurant objects, for very large data sets. Names are interned, and every open
+    # interval of every restaurant is one row of three flat arrays: restaurant_ids (in ascending order), starts and ends
+    # (week-minutes, which fit in unsigned 16 bits). Only the (rare) log messages and time zones are kept per
+    # restaurant, and the original schedule strings are not kept at all. Indexing the store returns a Restaurant built
+    # on demand, whose schedule_strings are None.
+    def __init__(self):
+        self.names = []
+        self.restaurant_ids = array('I')
+        self.starts = array('H')
+        self.ends = array('H')
+        self.log_messages = {}  # restaurant id -> log messages (only for restaurants that have any)
+        self.timezones = {}  # restaurant id -> time zone name (only for restaurants that have one)
+
+    def append(self, name, schedule_strings, timezone=None):
+        log_messages = []
+        intervals = map_schedules_to_intervals(schedule_strings, log_messages)
+        timezone = check_timezone(timezone, log_messages)
+        self.append_parsed(name, log_messages, intervals, timezone)
+
+    def append_parsed(self, name, log_messages, open_intervals, timezone=None):
+        restaurant_id = len(self.names)
+        self.names.append(sys.intern(name))
+        for start, end in open_intervals:
+            self.restaurant_ids.append(restaurant_id)
+            self.starts.append(start)
+            self.ends.append(end)
+        if log_messages:
+            self.log_messages[restaurant_id] = log_messages
+        if timezone is not None:
+            self.timezones[restaurant_id] = timezone
+
+    @classmethod
+    def from_columns(cls, names, restaurant_ids, starts, ends, log_messages, timezones=None):
+        # build a store around existing columns (any sequences, such as memoryviews of a snapshot) without copying
+        store = cls.__new__(cls)
+        store.names = names
+        store.restaurant_ids = restaurant_ids
+        store.starts = starts
+        store.ends = ends
+        store.log_messages = log_messages
+        store.timezones = timezones if timezones is not None else {}
+        return store
+
+    def extend_columns(self, names, interval_counts, starts, ends, log_messages, timezones):
+        # append restaurants that were parsed elsewhere (see parse_restaurant_chunk); log_messages and timezones are
+        # keyed by position
+        first_restaurant_id = len(self.names)
+        for position, (name, interval_count) in enumerate(zip(names, interval_counts)):
+            self.names.append(sys.intern(name))
+            self.restaurant_ids.extend(repeat(first_restaurant_id + position, interval_count))
+        self.starts.extend(starts)
+        self.ends.extend(ends)
+        for position in log_messages:
+            self.log_messages[first_restaurant_id + position] = log_messages[position]
+        for position in timezones:
+            self.timezones[first_restaurant_id + position] = timezones[position]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, restaurant_id):
+        if restaurant_id < 0:
+            restaurant_id += len(self.names)
+        name = self.names[restaurant_id]  # raises IndexError for ids out of range
+        return Restaurant.from_parsed(name, None, self.log_messages.get(restaurant_id, []),
+                                      self.get_open_intervals(restaurant_id), self.timezones.get(restaurant_id))
+
+    def get_name(self, restaurant_id):
+        return self.names[restaurant_id]  # without building a Restaurant
+
+    def get_interval_rows(self, restaurant_id):
+        # the rows of the restaurant's intervals in the columns (restaurant ids ascend, so they are contiguous)
+        first = bisect_left(self.restaurant_ids, restaurant_id)
+        return range(first, bisect_right(self.restaurant_ids, restaurant_id, first))
+
+    def get_open_intervals(self, restaurant_id):
+        rows = self.get_interval_rows(restaurant_id)
+        return list(zip(self.starts[rows.start:rows.stop], self.ends[rows.start:rows.stop]))
+
+    def iterate_intervals(self):
+        return zip(self.restaurant_ids, self.starts, self.ends)
+
+
+class RestaurantStoreSelection:
+    # Some of the restaurants of a RestaurantStore (such as those of one time zone, see ShardedRestaurantIndex), read
+    # from the store's columns rather than copied out of them, so a memory-mapped store stays mapped. Position i of
+    # the selection is the store's restaurant restaurant_ids[i].
+    def __init__(self, store, restaurant_ids):
+        self.store = store
+        self.restaurant_ids = restaurant_ids
+
+    def __len__(self):
+        return len(self.restaurant_ids)
+
+    def __getitem__(self, position):
+        return self.store[self.restaurant_ids[position]]
+
+    def get_name(self, position):
+        return self.store.get_name(self.restaurant_ids[position])
+
+    def iterate_intervals(self):
+        for position, restaurant_id in enumerate(self.restaurant_ids):
+            for row in self.store.get_interval_rows(restaurant_id):
+                yield position, self.store.starts[row], self.store.ends[row]
+
+
+def iterate_intervals(restaurants):
+    # (position, start, end) for every open interval of a list of restaurants, a RestaurantStore or a selection of one
+    if isinstance(restaurants, (RestaurantStore, RestaurantStoreSelection)):
+        return restaurants.iterate_intervals()
+    return ((position, start, end)
+            for position, restaurant in enumerate(restaurants) for start, end in restaurant.open_intervals)
+
+
+# ============================== Index functions
+
+
+class ResultCache:
+    # a bounded mapping that evicts the least recently used entry, counting hits and misses
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def to_dict(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+def make_bitset(positions, count):
+    # build the integer bitset in a bytearray (setting bits of a large int one at a time would copy it every time)
+    bits = bytearray((count + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def iterate_bitset(bits):
+    binary = bin(bits)[:1:-1]  # least-significant bit first, so string index == bit position
+    position = binary.find('1')
+    while position >= 0:
+        yield position
+        position = binary.find('1', position + 1)
+
+
+def record_index_query(started, positions):
+    g_metrics.record('query.index_seconds', perf_counter() - started)
+    g_metrics.increment('query.restaurants_returned', len(positions))
+
+
+class RestaurantIndex:
+    # Maps week-minutes to open restaurants. Every open/close time in the data is a boundary that cuts the week into
+    # segments; within a segment the set of open restaurants cannot change, so it is stored once as a bitset of
+    # positions in the restaurant list. A query is a binary search for the segment plus decoding its bits.
+    # The restaurants can be a list of Restaurant objects, or a RestaurantStore or RestaurantStoreSelection (which is
+    # referenced, not copied).
+    def __init__(self, restaurants):
+        if isinstance(restaurants, (RestaurantStore, RestaurantStoreSelection)):
+            self.restaurants = restaurants
+        else:
+            self.restaurants = list(restaurants)
+
+        # positions of the restaurants whose open state flips at each boundary (merged intervals never overlap, so
+        # each start or end is a simple toggle)
+        toggles = {0: []}
+        for position, start, end in iterate_intervals(self.restaurants):
+            augment_map(toggles, start, position)
+            augment_map(toggles, end, position)
+        toggles.pop(g_minutes_per_week, None)  # closing at the end of the week starts no new segment
+
+        self.boundaries = sorted(toggles.keys())
+        self.segment_bits = []
+        bits = 0
+        for boundary in self.boundaries:
+            bits ^= make_bitset(toggles[boundary], len(self.restaurants))
+            self.segment_bits.append(bits)
+
+        # the open set is the same throughout a segment, so name-sorted results are cached by segment; a changed
+        # restaurant set means a new index (and so an empty cache), or call clear_results after changing the store
+        self.result_cache = ResultCache(g_result_cache_size)
+
+    @classmethod
+    def from_segments(cls, restaurants, boundaries, segment_bits):
+        # build an index from already-computed segments (such as those of a snapshot)
+        restaurant_index = cls.__new__(cls)
+        restaurant_index.restaurants = restaurants
+        restaurant_index.boundaries = boundaries
+        restaurant_index.segment_bits = segment_bits
+        restaurant_index.result_cache = ResultCache(g_result_cache_size)
+        return restaurant_index
+
+    def get_segment(self, week_minute):
+        return bisect_right(self.boundaries, week_minute) - 1
+
+    def get_open_positions_at(self, week_minute):
+        # positions (in the restaurant list or store) of the open restaurants, without building any restaurant objects
+        started = perf_counter() if g_metrics is not None else 0.0
+        positions = list(iterate_bitset(self.segment_bits[self.get_segment(week_minute % g_minutes_per_week)]))
+        if g_metrics is not None:
+            record_index_query(started, positions)
+        return positions
+
+    def get_open_restaurants_at(self, week_minute):
+        return [self.restaurants[position] for position in self.get_open_positions_at(week_minute)]
+
+    def get_name(self, position):
+        if isinstance(self.restaurants, (RestaurantStore, RestaurantStoreSelection)):
+            return self.restaurants.get_name(position)  # without building a Restaurant
+        return self.restaurants[position].name
+
+    def get_sorted_results_at(self, week_minute):
+        # (names, positions) of the open restaurants, both sorted by name; the tuples are shared by every query that
+        # falls in the same segment, so they must not be (and cannot be) changed
+        started = perf_counter() if g_metrics is not None else 0.0
+        segment = self.get_segment(week_minute % g_minutes_per_week)
+        results = self.result_cache.get(segment)
+        if results is None:
+            named_positions = sorted((self.get_name(position), position)
+                                     for position in iterate_bitset(self.segment_bits[segment]))
+            results = (tuple(name for name, position in named_positions),
+                       tuple(position for name, position in named_positions))
+            self.result_cache.put(segment, results)
+        if g_metrics is not None:
+            record_index_query(started, results[1])
+        return results
+
+    def get_open_names_at(self, week_minute):
+        return self.get_sorted_results_at(week_minute)[0]
+
+    def get_open_restaurants_by_name_at(self, week_minute):
+        return [self.restaurants[position] for position in self.get_sorted_results_at(week_minute)[1]]
+
+    def clear_results(self):
+        self.result_cache.clear()
+
+    def get_open_restaurants(self, dow, time):
+        return self.get_open_restaurants_at(get_week_minute(dow, time))
+
+    def get_open_positions_between(self, start_week_minute, end_week_minute):
+        # open for the whole window (see normalize_window): open in every segment the window touches, so AND together
+        # the bitsets of those segments (wrapping from the last segment of the week to the first)
+        started = perf_counter() if g_metrics is not None else 0.0
+        start, end = normalize_window(start_week_minute, end_week_minute)
+        first_segment = self.get_segment(start)
+        last_segment = self.get_segment((end - 1) % g_minutes_per_week)
+        if end > g_minutes_per_week:
+            segments = list(range(first_segment, len(self.boundaries))) + list(range(0, last_segment + 1))
+        else:
+            segments = range(first_segment, last_segment + 1)
+
+        bits = self.segment_bits[first_segment]
+        for segment in segments:
+            if not bits:
+                break
+            bits &= self.segment_bits[segment]
+        positions = list(iterate_bitset(bits))
+        if g_metrics is not None:
+            record_index_query(started, positions)
+        return positions
+
+    def get_open_restaurants_between(self, start_week_minute, end_week_minute):
+        return [self.restaurants[position]
+                for position in self.get_open_positions_between(start_week_minute, end_week_minute)]
+
+    def get_open_restaurants_batch(self, week_minutes):
+        # look up every segment first, then decode each distinct segment only once (a month of 5-minute slots
+        # touches at most a few hundred segments); results for the same segment share one tuple
+        segments = [self.get_segment(week_minute % g_minutes_per_week) for week_minute in week_minutes]
+        segment_restaurants = {}
+        for segment in set(segments):
+            segment_restaurants[segment] = tuple(self.restaurants[position]
+                                                 for position in iterate_bitset(self.segment_bits[segment]))
+        return [segment_restaurants[segment] for segment in segments]
+
+    def get_open_names_batch(self, week_minutes):
+        # like get_open_restaurants_batch, but the names of each distinct segment come from get_sorted_results_at
+        # (sorted and cached, without building any restaurant objects)
+        segment_names = {}
+        results = []
+        for week_minute in week_minutes:
+            segment = self.get_segment(week_minute % g_minutes_per_week)
+            if segment not in segment_names:
+                segment_names[segment] = self.get_open_names_at(week_minute)
+            results.append(segment_names[segment])
+        return results
+
+
+RestaurantShard = namedtuple('RestaurantShard', ('timezone', 'restaurant_index', 'positions'))
+
+
+class ShardedRestaurantIndex:
+    # Answers queries for restaurants in many time zones. The same schedule is open at different instants in different
+    # zones, so the restaurants are split by time zone into shards, each with its own RestaurantIndex (restaurants
+    # without a time zone share one shard). A query converts its date and time once per shard, not once per
+    # restaurant: an aware one (such as UTC) becomes the shard's local time, while a naive one is taken as local
+    # everywhere, as in the original model. The shards are queried one after another (each lookup takes microseconds,
+    # less than handing it to another thread or process would) and their results merged.
+    # Positions are those in the restaurants the index was built from (a list or a RestaurantStore, as for
+    # RestaurantIndex); each shard maps its own positions back to them. The shards of a store are selections of it
+    # (see RestaurantStoreSelection), so nothing is copied out of a memory-mapped snapshot.
+    def __init__(self, restaurants, restaurant_index=None):
+        self.restaurants = restaurants if isinstance(restaurants, RestaurantStore) else list(restaurants)
+        if isinstance(self.restaurants, RestaurantStore):
+            timezones = self.restaurants.timezones
+        else:
+            timezones = {position: r.timezone for position, r in enumerate(self.restaurants) if r.timezone is not None}
+
+        if not timezones:
+            # the usual case: one shard of all the restaurants (reusing a given index over them, such as a snapshot's)
+            if restaurant_index is None:
+                restaurant_index = RestaurantIndex(self.restaurants)
+            self.shards = [RestaurantShard(None, restaurant_index, range(len(self.restaurants)))]
+            return
+
+        positions_by_timezone = {}  # time zone -> array of positions (not a list of int objects, for large stores)
+        for position in range(len(self.restaurants)):
+            timezone = timezones.get(position)
+            if timezone not in positions_by_timezone:
+                positions_by_timezone[timezone] = array('I')
+            positions_by_timezone[timezone].append(position)
+        self.shards = []
+        for timezone in sorted(positions_by_timezone, key=lambda shard_timezone: shard_timezone or ''):
+            positions = positions_by_timezone[timezone]
+            if isinstance(self.restaurants, RestaurantStore):
+                shard_restaurants = RestaurantStoreSelection(self.restaurants, positions)
+            else:
+                shard_restaurants = [self.restaurants[position] for position in positions]
+            self.shards.append(RestaurantShard(timezone, RestaurantIndex(shard_restaurants), positions))
+
+    @classmethod
+    def from_index(cls, restaurant_index):
+        # shard the restaurants of an existing index (which is used as is when none of them has a time zone)
+        return cls(restaurant_index.restaurants, restaurant_index)
+
+    def get_shard_week_minutes(self, datetime_object):
+        # the date and time as a week-minute in each shard's time zone
+        return [transform_datetime_to_week_minute(transform_datetime_to_timezone(datetime_object, shard.timezone))
+                for shard in self.shards]
+
+    def merge_positions(self, shard_positions):
+        # positions found in each shard (ascending) -> ascending positions in the restaurants
+        if len(self.shards) == 1:
+            return shard_positions[0]
+        return list(heapq.merge(*([shard.positions[position] for position in positions]
+                                  for shard, positions in zip(self.shards, shard_positions))))
+
+    def get_open_positions_at(self, datetime_object):
+        return self.merge_positions([shard.restaurant_index.get_open_positions_at(week_minute)
+                                     for shard, week_minute in zip(self.shards,
+                                                                   self.get_shard_week_minutes(datetime_object))])
+
+    def get_open_restaurants_at(self, datetime_object):
+        return [self.restaurants[position] for position in self.get_open_positions_at(datetime_object)]
+
+    def get_name(self, position):
+        if isinstance(self.restaurants, RestaurantStore):
+            return self.restaurants.get_name(position)  # without building a Restaurant
+        return self.restaurants[position].name
+
+    def get_open_names_at(self, datetime_object):
+        # sorted by name; with one shard, this is its cached tuple (see RestaurantIndex.get_sorted_results_at)
+        shard_names = [shard.restaurant_index.get_open_names_at(week_minute)
+                       for shard, week_minute in zip(self.shards, self.get_shard_week_minutes(datetime_object))]
+        if len(shard_names) == 1:
+            return shard_names[0]
+        return tuple(heapq.merge(*shard_names))
+
+    def get_open_restaurants_by_name_at(self, datetime_object):
+        shard_restaurants = [shard.restaurant_index.get_open_restaurants_by_name_at(week_minute)
+                             for shard, week_minute in zip(self.shards, self.get_shard_week_minutes(datetime_object))]
+        return list(heapq.merge(*shard_restaurants, key=lambda restaurant: restaurant.name))
+
+    def get_open_restaurants_between(self, start_datetime_object, end_datetime_object):
+        return [self.restaurants[position]
+                for position in self.get_open_positions_between(start_datetime_object, end_datetime_object)]
+
+    def get_open_positions_between(self, start_datetime_object, end_datetime_object):
+        # open for the whole time from start to end (at most a week, see RestaurantIndex.get_open_positions_between);
+        # the end must be at least a minute after the start, since normalize_window reads a shorter window as a wrap
+        if (end_datetime_object - start_datetime_object).total_seconds() // 60 <= 0:
+            raise ValueError('The end must be at least a minute after the start')
+        shard_positions = []
+        for shard in self.shards:
+            # the window is measured on the shard's wall clock, which may gain or lose an hour across a DST change
+            # (a window that ends at an earlier wall-clock time, inside a repeated hour, is taken as a minute long)
+            local_start = transform_datetime_to_timezone(start_datetime_object, shard.timezone)
+            local_end = transform_datetime_to_timezone(end_datetime_object, shard.timezone)
+            window_minutes = (local_end.replace(tzinfo=None) - local_start.replace(tzinfo=None)).total_seconds() // 60
+            week_minute = transform_datetime_to_week_minute(local_start)
+            shard_positions.append(shard.restaurant_index.get_open_positions_between(
+                week_minute, week_minute + int(min(max(window_minutes, 1), g_minutes_per_week))))
+        return self.merge_positions(shard_positions)
+
+    def get_open_restaurants_batch(self, datetime_objects):
+        # one tuple of open restaurants per date and time, each shard decoding a segment only once (see
+        # RestaurantIndex.get_open_restaurants_batch); with several shards, the restaurants are grouped by shard
+        shard_results = []
+        for shard in self.shards:
+            week_minutes = [transform_datetime_to_week_minute(transform_datetime_to_timezone(d, shard.timezone))
+                            for d in datetime_objects]
+            shard_results.append(shard.restaurant_index.get_open_restaurants_batch(week_minutes))
+        if len(shard_results) == 1:
+            return shard_results[0]
+        return [tuple(chain.from_iterable(results)) for results in zip(*shard_results)]
+
+    def get_open_names_batch(self, datetime_objects):
+        # one name-sorted tuple of open restaurant names per date and time (see RestaurantIndex.get_open_names_batch)
+        shard_results = []
+        for shard in self.shards:
+            week_minutes = [transform_datetime_to_week_minute(transform_datetime_to_timezone(d, shard.timezone))
+                            for d in datetime_objects]
+            shard_results.append(shard.restaurant_index.get_open_names_batch(week_minutes))
+        if len(shard_results) == 1:
+            return shard_results[0]
+        return [tuple(heapq.merge(*names)) for names in zip(*shard_results)]
+
+    def get_open_restaurants(self, dow, time):
+        # the original query, without time zones: the day and time are local to every restaurant
+        week_minute = get_week_minute(dow, time)
+        return [self.restaurants[position] for position in self.merge_positions(
+            [shard.restaurant_index.get_open_positions_at(week_minute) for shard in self.shards])]
+
+    def get_result_cache_info(self):
+        # the result caches of all the shards, added together
+        result_caches = [shard.restaurant_index.result_cache for shard in self.shards]
+        hits = sum(result_cache.hits for result_cache in result_caches)
+        misses = sum(result_cache.misses for result_cache in result_caches)
+        return {'size': sum(len(result_cache.entries) for result_cache in result_caches),
+                'max_size': sum(result_cache.max_size for result_cache in result_caches), 'hits': hits,
+                'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+    def clear_results(self):
+        for shard in self.shards:
+            shard.restaurant_index.clear_results()
+
+
+def get_open_restaurants_for_datetimes(restaurant_index, datetime_objects):
+    if isinstance(restaurant_index, ShardedRestaurantIndex):
+        return restaurant_index.get_open_restaurants_batch(datetime_objects)
+    week_minutes = [transform_datetime_to_week_minute(d) for d in datetime_objects]
+    return restaurant_index.get_open_restaurants_batch(week_minutes)
+
+
+def get_open_names_for_datetimes(restaurant_index, datetime_objects):
+    # the names (sorted) of the restaurants open at each date and time; for large stores this is much faster than
+    # get_open_restaurants_for_datetimes, which builds a Restaurant for every result
+    if isinstance(restaurant_index, ShardedRestaurantIndex):
+        return restaurant_index.get_open_names_batch(datetime_objects)
+    week_minutes = [transform_datetime_to_week_minute(d) for d in datetime_objects]
+    return restaurant_index.get_open_names_batch(week_minutes)
+
+
+# ============================== Snapshot functions
+
+
+# A snapshot is the parsed restaurants and their index, saved in a binary file that is memory-mapped at startup instead
+# of parsing the JSON file again. Layout (little-endian, each section padded to a multiple of 8 bytes):
+#   header (g_snapshot_header): magic, version, section sizes, and the size, mtime and SHA-256 of the source file
+#   name offsets (uint32 x restaurant count + 1) and the UTF-8 name table
+#   log messages and time zones (JSON object: {"log_messages": {id: messages}, "timezones": {id: time zone name}})
+#   restaurant ids (uint32), starts (uint16) and ends (uint16), one row per interval
+#   segment boundaries (uint16) and one bitset (bitset_bytes bytes) per segment
+g_snapshot_magic = b'FRSNAP\0\0'
+g_snapshot_version = 2
+g_snapshot_header = struct.Struct('<8sIIIIIIIqq32s')
+
+
+def get_file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(g_read_chunk_size), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def pad_to_8(byte_count):
+    return (byte_count + 7) & ~7
+
+
+def write_snapshot(snapshot_file_path, restaurant_index, restaurant_file_path):
+    store = restaurant_index.restaurants
+    names = [store.names[i].encode('utf-8') for i in range(len(store))]
+    name_offsets = array('I', [0])
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+    log_bytes = json.dumps({'log_messages': store.log_messages, 'timezones': store.timezones}).encode('utf-8')
+    bitset_bytes = (len(store) + 7) // 8
+    source_stat = os.stat(restaurant_file_path)
+
+    header = g_snapshot_header.pack(g_snapshot_magic, g_snapshot_version, len(store), len(store.restaurant_ids),
+                                    len(restaurant_index.boundaries), bitset_bytes, name_offsets[-1], len(log_bytes),
+                                    source_stat.st_size, source_stat.st_mtime_ns, get_file_digest(restaurant_file_path))
+    sections = [header, name_offsets.tobytes(), b''.join(names), log_bytes,
+                array('I', store.restaurant_ids).tobytes(), array('H', store.starts).tobytes(),
+                array('H', store.ends).tobytes(), array('H', restaurant_index.boundaries).tobytes(),
+                b''.join(bits.to_bytes(bitset_bytes, 'little') for bits in restaurant_index.segment_bits)]
+
+    # write to a temporary file and rename it, so a reader never maps a half-written snapshot
+    temp_file_path = snapshot_file_path + '.tmp'
+    with open(temp_file_path, 'wb') as snapshot_file:
+        for section in sections:
+            snapshot_file.write(section)
+            snapshot_file.write(bytes(pad_to_8(len(section)) - len(section)))
+    os.replace(temp_file_path, snapshot_file_path)
+
+
+class SnapshotNames:
+    # read-only sequence of the names in a snapshot, decoded from its name table on demand
+    def __init__(self, name_offsets, name_table):
+        self.name_offsets = name_offsets
+        self.name_table = name_table
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    def __getitem__(self, restaurant_id):
+        return str(self.name_table[self.name_offsets[restaurant_id]:self.name_offsets[restaurant_id + 1]], 'utf-8')
+
+
+class SnapshotBitsets:
+    # read-only sequence of the segment bitsets in a snapshot, converted to integers on demand
+    def __init__(self, bitsets, segment_count, bitset_bytes):
+        self.bitsets = bitsets
+        self.segment_count = segment_count
+        self.bitset_bytes = bitset_bytes
+
+    def __len__(self):
+        return self.segment_count
+
+    def __getitem__(self, segment):
+        if not 0 <= segment < self.segment_count:
+            raise IndexError('segment out of range')
+        offset = segment * self.bitset_bytes
+        return int.from_bytes(self.bitsets[offset:offset + self.bitset_bytes], 'little')
+
+
+def is_snapshot_current(header_fields, restaurant_file_path):
+    # current if the source file is unchanged: same size and mtime, or (if only the mtime differs) the same contents
+    source_size, source_mtime_ns, source_digest = header_fields[-3:]
+    source_stat = os.stat(restaurant_file_path)
+    if source_stat.st_size != source_size:
+        return False
+    if source_stat.st_mtime_ns == source_mtime_ns:
+        return True
+    return get_file_digest(restaurant_file_path) == source_digest
+
+
+def read_snapshot(snapshot_file_path, restaurant_file_path):
+    # returns a RestaurantIndex over the memory-mapped snapshot (its arrays are views of the mapping, not copies), or
+    # None if there is no usable snapshot that is current with the restaurant file
+    try:
+        with open(snapshot_file_path, 'rb') as snapshot_file:
+            mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # missing, unreadable, or empty
+        return None
+
+    view = memoryview(mapping)
+    if len(view) < g_snapshot_header.size:
+        return None
+    header_fields = g_snapshot_header.unpack_from(view)
+    magic, version, restaurant_count, interval_count, boundary_count, bitset_bytes, name_bytes, log_bytes = \
+        header_fields[:8]
+    if magic != g_snapshot_magic or version != g_snapshot_version or \
+            not is_snapshot_current(header_fields, restaurant_file_path):
+        return None
+
+    offset = pad_to_8(g_snapshot_header.size)
+    sections = []
+    for byte_count in ((restaurant_count + 1) * 4, name_bytes, log_bytes, interval_count * 4, interval_count * 2,
+                       interval_count * 2, boundary_count * 2, boundary_count * bitset_bytes):
+        sections.append(view[offset:offset + byte_count])
+        offset += pad_to_8(byte_count)
+    if offset > pad_to_8(len(view)):
+        return None  # truncated
+    name_offsets, name_table, log_table, restaurant_ids, starts, ends, boundaries, bitsets = sections
+
+    log_table = json.loads(str(log_table, 'utf-8'))
+    log_messages = {int(restaurant_id): messages for restaurant_id, messages in log_table['log_messages'].items()}
+    timezones = {int(restaurant_id): timezone for restaurant_id, timezone in log_table['timezones'].items()}
+    store = RestaurantStore.from_columns(SnapshotNames(name_offsets.cast('I'), name_table), restaurant_ids.cast('I'),
+                                         starts.cast('H'), ends.cast('H'), log_messages, timezones)
+    return RestaurantIndex.from_segments(store, boundaries.cast('H'),
+                                         SnapshotBitsets(bitsets, boundary_count, bitset_bytes))
+
+
+def load_restaurant_index(restaurant_file_path, snapshot_file_path, warning_sink=None):
+    # use the compiled snapshot if it is current, otherwise parse the restaurant file (streaming it into a store)
+    restaurant_index = read_snapshot(snapshot_file_path, restaurant_file_path)
+    if restaurant_index is not None:
+        print(f'\tUsing compiled snapshot "{snapshot_file_path}".')
+        if warning_sink is not None:
+            store = restaurant_index.restaurants
+            for restaurant_id in sorted(store.log_messages):
+                for message in store.log_messages[restaurant_id]:
+                    warning_sink(ParseWarning(restaurant_id, store.names[restaurant_id], message))
+        return restaurant_index
+
+    return RestaurantIndex(stream_restaurant_store(restaurant_file_path, warning_sink))
+
+
+# ============================== Reload functions
+
+
+def get_file_identity(file_path):
+    file_stat = os.stat(file_path)
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+class RestaurantIndexReloader:
+    # Keeps a ShardedRestaurantIndex current with the restaurant file. When the file changes (checked on a worker
+    # thread, see start, or by calling check_for_changes), a new index is built and then swapped in with a single
+    # assignment, so a query that reads restaurant_index once gets a complete index (old or new, never a mix).
+    # The restaurants are loaded into a compact RestaurantStore (as from a snapshot), and schedules (times and time
+    # zone) already parsed by the previous load are reused instead of being parsed again.
+    def __init__(self, restaurant_file_path, restaurant_index=None, poll_seconds=g_reload_poll_seconds,
+                 warning_sink=None):
+        self.restaurant_file_path = restaurant_file_path
+        self.poll_seconds = poll_seconds
+        self.warning_sink = warning_sink
+        self.restaurant_store = None  # the RestaurantStore of the last load
+        self.schedule_ids = {}  # (times, timezone) -> id of a restaurant with that schedule in restaurant_store
+        self.reload_count = 0
+        self.parsed_count = 0  # schedules parsed (rather than reused) by the last load
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.file_identity = get_file_identity(restaurant_file_path)
+        self.restaurant_index = restaurant_index  # e.g. from a snapshot; its restaurants get parsed on the first change
+        if restaurant_index is None:
+            self.reload()
+
+    def reload(self):
+        file_identity = get_file_identity(self.restaurant_file_path)
+        json_lines = self.restaurant_file_path.endswith(g_json_lines_extensions)
+        store = RestaurantStore()
+        schedule_ids = {}
+        parsed_count = 0
+        with open(self.restaurant_file_path) as restaurant_file:
+            for restaurant_id, record in enumerate(iterate_restaurant_records(restaurant_file, json_lines)):
+                # the times are joined into one string so the keys stay small (the store holds the parsed schedule)
+                key = ('\n'.join(record['times']), record.get('timezone'))
+                known_store, known_id = store, schedule_ids.get(key)
+                if known_id is None:
+                    known_store, known_id = self.restaurant_store, self.schedule_ids.get(key)
+                if known_id is not None:
+                    log_messages = known_store.log_messages.get(known_id, [])
+                    open_intervals = known_store.get_open_intervals(known_id)
+                    timezone = known_store.timezones.get(known_id)
+                else:
+                    log_messages = []
+                    open_intervals = map_schedules_to_intervals(record['times'], log_messages)
+                    timezone = check_timezone(record.get('timezone'), log_messages)
+                    parsed_count += 1
+                if self.warning_sink is not None and key not in self.schedule_ids:  # already reported otherwise
+                    for message in log_messages:
+                        self.warning_sink(ParseWarning(restaurant_id, record['name'], message))
+                schedule_ids.setdefault(key, restaurant_id)
+                store.append_parsed(record['name'], log_messages, open_intervals, timezone)
+
+        self.restaurant_index = ShardedRestaurantIndex(store)  # the swap: one reference assignment
+        self.restaurant_store = store
+        self.schedule_ids = schedule_ids
+        self.file_identity = file_identity
+        self.parsed_count = parsed_count
+        self.reload_count += 1
+
+    def check_for_changes(self):
+        # returns whether the file changed and was reloaded; on errors (such as a half-written file) the current index
+        # is kept, and the next change to the file is tried again
+        try:
+            file_identity = get_file_identity(self.restaurant_file_path)
+            if file_identity == self.file_identity:
+                return False
+            self.file_identity = file_identity
+            self.reload()
+            return True
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print(f'Warning: Could not reload restaurant file "{self.restaurant_file_path}": {error}', file=sys.stderr)
+            return False
+
+    def watch(self):
+        while not self.stop_event.wait(self.poll_seconds):
+            self.check_for_changes()
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.watch, name='restaurant-reloader', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+# ============================== Service functions
+
+
+g_http_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  413: 'Content Too Large', 500: 'Internal Server Error'}
+
+
+def format_open_result(datetime_object, names):
+    # the names must already be sorted
+    dow, time = format_week_minute(transform_datetime_to_week_minute(datetime_object))
+    return {'at': datetime_object.isoformat(timespec='minutes'), 'dow': dow, 'time': time, 'count': len(names),
+            'names': names}
+
+
+class RestaurantService:
+    # Answers HTTP queries from restaurants loaded once (see serve), or kept current by a RestaurantIndexReloader:
+    #   GET /open?at=<date and time>                -> which restaurants are open at that time
+    #   GET /open?at=<date and time>&until=<date and time>  -> which are open for that whole time
+    #   POST /open/batch with {"at": [<date and time>, ...]}  -> a list of those results, one per date and time
+    #   GET /metrics                                -> request counts and latencies per route
+    def __init__(self, restaurant_index, reloader=None):
+        self.restaurant_index = restaurant_index
+        self.reloader = reloader
+        self.latencies = {}  # route -> LatencyHistogram
+
+    def get_restaurant_index(self):
+        # each request reads this once, so it sees one whole index even if a reload swaps in a new one meanwhile
+        return self.reloader.restaurant_index if self.reloader is not None else self.restaurant_index
+
+    def handle_request(self, method, target, body):
+        # returns the HTTP status and a JSON-serializable response
+        url = urllib.parse.urlsplit(target)
+        routes = {'/open': ('GET', self.get_open), '/open/batch': ('POST', self.post_open_batch),
+                  '/metrics': ('GET', self.get_metrics)}
+        if url.path not in routes:
+            return 404, {'error': f'Unknown path "{url.path}"'}
+        route_method, handler = routes[url.path]
+        if method != route_method:
+            return 405, {'error': f'Use {route_method} for "{url.path}"'}
+
+        started = perf_counter()
+        try:
+            result = 200, handler(urllib.parse.parse_qs(url.query), body)
+        except (ValueError, KeyError, TypeError, OverflowError) as error:
+            result = 400, {'error': str(error)}
+        if url.path not in self.latencies:
+            self.latencies[url.path] = LatencyHistogram()
+        self.latencies[url.path].record(perf_counter() - started)
+        return result
+
+    def get_open(self, query, body):
+        if 'at' not in query:
+            raise ValueError('Missing "at" query parameter')
+        datetime_object = parse_datetime(query['at'][0])
+        if 'until' not in query:
+            return format_open_result(datetime_object,
+                                      list(self.get_restaurant_index().get_open_names_at(datetime_object)))
+
+        until_datetime_object = parse_datetime(query['until'][0])
+        restaurant_index = self.get_restaurant_index()
+        names = sorted(restaurant_index.get_name(position)
+                       for position in restaurant_index.get_open_positions_between(datetime_object,
+                                                                                   until_datetime_object))
+        result = format_open_result(datetime_object, names)
+        result['until'] = until_datetime_object.isoformat(timespec='minutes')
+        return result
+
+    def post_open_batch(self, query, body):
+        request = json.loads(body)
+        datetime_strings = request['at'] if isinstance(request, dict) else request
+        if not isinstance(datetime_strings, list):
+            raise ValueError('Expected {"at": [<date and time>, ...]}')
+        datetime_objects = [parse_datetime(datetime_string) for datetime_string in datetime_strings]
+        restaurant_index = self.get_restaurant_index()
+        return [format_open_result(d, list(restaurant_index.get_open_names_at(d))) for d in datetime_objects]
+
+    def get_metrics(self, query, body):
+        restaurant_index = self.get_restaurant_index()
+        metrics = {'restaurants': len(restaurant_index.restaurants), 'shards': len(restaurant_index.shards),
+                   'result_cache': restaurant_index.get_result_cache_info(),
+                   'latency': {path: self.latencies[path].to_dict() for path in sorted(self.latencies)}}
+        if self.reloader is not None:
+            metrics['reloads'] = self.reloader.reload_count
+        return metrics
+
+    async def handle_connection(self, reader, writer):
+        import asyncio  # already loaded by whoever started the server
+        # minimal HTTP/1.1: one request at a time per connection, kept alive unless the client asks to close
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    header_line = await reader.readline()
+                    if not header_line.strip():
+                        break
+                    name, _, value = header_line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                request_parts = request_line.decode('latin-1').split()
+                content_length_string = headers.get('content-length', '0')
+                content_length = int(content_length_string) if content_length_string.isdigit() else -1
+                if len(request_parts) != 3 or content_length < 0:
+                    status, response = 400, {'error': 'Malformed request'}
+                    keep_alive = False
+                elif content_length > g_max_request_body_bytes:
+                    status, response = 413, {'error': f'Request body over {g_max_request_body_bytes} bytes'}
+                    keep_alive = False
+                else:
+                    method, target, version = request_parts
+                    body = await reader.readexactly(content_length)
+                    try:
+                        status, response = self.handle_request(method, target, body)
+                    except Exception as error:  # a bug, not a bad request: answer it and keep serving
+                        print(f'Error: Request "{method} {target}" failed: {error!r}', file=sys.stderr)
+                        status, response = 500, {'error': 'Internal server error'}
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                response_body = json.dumps(response).encode('utf-8')
+                writer.write(f'HTTP/1.1 {status} {g_http_reasons[status]}\r\n'
+                             'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(response_body)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1'))
+                writer.write(response_body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass  # the client went away or sent something unreadable; just drop the connection
+        finally:
+            writer.close()
+
+
+async def run_service(restaurant_service, host, port):
+    import asyncio
+    server = await asyncio.start_server(restaurant_service.handle_connection, host, port)
+    async with server:
+        for server_socket in server.sockets:
+            print(f'Serving on http://{server_socket.getsockname()[0]}:{server_socket.getsockname()[1]} '
+                  '(Ctrl+C to stop)...')
+        await server.serve_forever()
+
+
+# ============================== Benchmark functions
+
+
+def format_clock_time(day_minute):
+    # the data file's 12-hour format, e.g. "9 am", "11:30 pm" (minutes omitted on the hour, like most of the data)
+    hr, minute = divmod(day_minute % g_minutes_per_day, 60)
+    clock_hr = hr % 12 or 12
+    ampm = 'am' if hr < 12 else 'pm'
+    return f'{clock_hr}:{minute:02} {ampm}' if minute else f'{clock_hr} {ampm}'
+
+
+def generate_schedule_string(rng):
+    # a random schedule in the grammar parse_schedule_intervals accepts: one or two day ranges (which may wrap around
+    # the end of the week), and half-hour times whose range may extend past midnight
+    def generate_dow_range():
+        start = rng.randrange(len(g_days_of_week))
+        if rng.random() < 0.3:
+            return g_days_of_week[start]
+        return f'{g_days_of_week[start]}-{g_days_of_week[(start + rng.randrange(1, 7)) % 7]}'
+
+    dow_ranges = generate_dow_range()
+    if rng.random() < 0.25:
+        dow_ranges += f', {generate_dow_range()}'
+    open_minute = rng.randrange(10, 36) * 30  # 5 am .. 5:30 pm
+    close_minute = open_minute + rng.randrange(4, 32) * 30  # 2 to 16 hours later, possibly after midnight
+    return f'{dow_ranges} {format_clock_time(open_minute)} - {format_clock_time(close_minute)}'
+
+
+def write_synthetic_restaurants(restaurant_file_path, venue_count, seed):
+    # written as JSON Lines, one venue at a time, so even 10 million venues never sit in memory
+    rng = random.Random(seed)
+    schedule_count = 0
+    with open(restaurant_file_path, 'w') as restaurant_file:
+        for venue_number in range(venue_count):
+            times = [generate_schedule_string(rng) for _ in range(rng.randint(1, 3))]
+            schedule_count += len(times)
+            restaurant_file.write(json.dumps({'name': f'Venue {venue_number}', 'times': times}) + '\n')
+    return schedule_count
+
+
+def get_peak_rss_bytes():
+    # peak resident set size of this process so far (None where the resource module is unavailable, e.g. Windows)
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024  # macOS reports bytes, Linux kilobytes
+
+
+def get_sorted_percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_benchmark(venue_count, query_count=g_bench_query_count, seed=g_bench_seed):
+    # times the load path (file -> Restaurant -> parse_schedule_intervals, into a store), the index build, and
+    # random point queries against the index (finding the open positions; looking up names is separate)
+    with tempfile.TemporaryDirectory() as temp_folder_path:
+        restaurant_file_path = os.path.join(temp_folder_path, 'restaurants.jsonl')
+        schedule_count = write_synthetic_restaurants(restaurant_file_path, venue_count, seed)
+        file_bytes = os.path.getsize(restaurant_file_path)
+
+        parse_normalized_schedule.cache_clear()
+        started = perf_counter()
+        store = stream_restaurant_store(restaurant_file_path)
+        parse_seconds = perf_counter() - started
+    cache_info = get_schedule_cache_info()
+
+    started = perf_counter()
+    restaurant_index = RestaurantIndex(store)
+    index_seconds = perf_counter() - started
+
+    rng = random.Random(seed)
+    latencies = []
+    for _ in range(query_count):
+        week_minute = rng.randrange(g_minutes_per_week)
+        started = perf_counter()
+        restaurant_index.get_open_positions_at(week_minute)
+        latencies.append(perf_counter() - started)
+    latencies.sort()
+
+    return {'venues': venue_count,
+            'schedule_strings': schedule_count,
+            'intervals': len(store.restaurant_ids),
+            'file_bytes': file_bytes,
+            'parse_seconds': parse_seconds,
+            'venues_per_second': venue_count / parse_seconds if parse_seconds else None,
+            'schedule_strings_per_second': schedule_count / parse_seconds if parse_seconds else None,
+            'schedule_cache_hits': cache_info.hits,
+            'schedule_cache_misses': cache_info.misses,
+            'index_seconds': index_seconds,
+            'segments': len(restaurant_index.boundaries),
+            'queries': query_count,
+            'query_p50_ms': get_sorted_percentile(latencies, 0.5) * 1000 if latencies else None,
+            'query_p99_ms': get_sorted_percentile(latencies, 0.99) * 1000 if latencies else None,
+            'peak_rss_bytes': get_peak_rss_bytes()}
+
+
 # ============================== Program functions
 
 
 def main():
     print(f'========== Reading restaurant file "{g_restaurants_file_path}"...')
-    all_restaurants = read_restaurant_schedules(g_restaurants_file_path)
-    print(f'\t{len(all_restaurants)} restaurants loaded.')
+    restaurant_index = ShardedRestaurantIndex.from_index(
+        load_restaurant_index(g_restaurants_file_path, g_snapshot_file_path, print_parse_warning))
+    print(f'\t{len(restaurant_index.restaurants)} restaurants loaded.')
+    reloader = RestaurantIndexReloader(g_restaurants_file_path, restaurant_index, warning_sink=print_parse_warning)
 
     while True:
         datetime_object = prompt_for_date_and_time()
         if datetime_object is None:
             return g_ERR_OK
 
-        dow, time = transform_datetime_to_dow_and_time(datetime_object)
-        open_restaurants = get_open_restaurants(all_restaurants, dow, time)
-        show_open_restaurant_names(open_restaurants, dow, time)
+        if reloader.check_for_changes():  # pick up edits to the file between queries
+            print(f'\tRestaurant file changed: {len(reloader.restaurant_index.restaurants)} restaurants loaded.')
+        open_restaurants = reloader.restaurant_index.get_open_restaurants_by_name_at(datetime_object)
+        show_open_restaurant_names(open_restaurants, datetime_object)
 
 
 def run_tests():
@@ -270,6 +1931,49 @@ def run_tests():
         date_time = datetime.strptime('2023-02-05 2:35 pm', datetime_format)
         assert transform_datetime_to_dow_and_time(date_time) == ('Sun', '1435')
 
+        assert transform_datetime_to_week_minute(date_time) == 6 * g_minutes_per_day + 14 * 60 + 35
+
+        date_time = datetime.strptime('2023-02-06 12:00 am', datetime_format)
+        assert transform_datetime_to_week_minute(date_time) == 0
+
+        # ==================== parse_datetime
+        assert parse_datetime('2023-02-06T13:30') == datetime(2023, 2, 6, 13, 30)
+        assert parse_datetime(' 2023-02-06 13:30:15 ') == datetime(2023, 2, 6, 13, 30, 15)
+        assert parse_datetime('Feb 6 2023 1:30 pm') == datetime(2023, 2, 6, 13, 30)  # free-form, via dateutil
+        try:
+            parse_datetime('bogus')
+            assert False
+        except ValueError:
+            pass
+        try:
+            parse_datetime(1)
+            assert False
+        except TypeError:
+            pass
+
+        # ==================== import time
+        # a fresh interpreter must import the module within budget and without the modules it defers
+        if not getattr(sys, 'frozen', False):
+            import subprocess
+            import_check = subprocess.run(
+                [sys.executable, '-c', 'import sys, time; started = time.perf_counter(); import FindRestaurants; '
+                 'print(time.perf_counter() - started, *sorted(set(sys.modules) & {"asyncio", "concurrent.futures", '
+                 '"cProfile", "dateutil", "multiprocessing", "pstats", "zoneinfo"}))'],
+                cwd=g_script_folder_path, capture_output=True, text=True, check=True)
+            import_seconds, *eager_modules = import_check.stdout.split()
+            assert not eager_modules, eager_modules
+            assert float(import_seconds) < g_import_time_budget_seconds, import_seconds
+
+        # ==================== integer minutes
+        assert get_day_minute('12', '00', 'am') == 0
+        assert get_day_minute('12', '30', 'pm') == 12 * 60 + 30
+        assert get_day_minute('9', '30', 'pm') == 21 * 60 + 30
+        assert get_week_minute('Mon', '0000') == 0
+        assert get_week_minute('Sun', '2359') == g_minutes_per_week - 1
+        assert format_day_minute(g_minutes_per_day) == '2400'
+        assert format_week_minute(get_week_minute('Wed', '1730')) == ('Wed', '1730')
+        assert get_minute_ranges('11', '00', 'pm', '02', '00', 'am') == ((23 * 60, g_minutes_per_day), (0, 120))
+
         # ==================== augment_map
         test_map = {}
         tuple_value1 = ('1', '2')
@@ -398,6 +2102,17 @@ def run_tests():
         assert dow_to_times['Sun'] == [('2200', '2400')]    # midnight end time represented by 2400
         assert dow_to_times['Mon'] == [('0000', '0200')]    # midnight start time represented by 0000
 
+        # ==================== parse_normalized_schedule
+        parse_normalized_schedule.cache_clear()
+        log_messages = []
+        intervals = parse_schedule_intervals('Mon-Tue 4 pm - 5 pm', log_messages)
+        assert intervals == ((960, 1020), (2400, 2460)) and isinstance(intervals, tuple)
+        assert parse_schedule_intervals('Mon-Tue  4 pm -\t5 pm', log_messages) is intervals     # same normalized string
+        assert parse_schedule_intervals('Mon', log_messages) == () and len(log_messages) == 1
+        assert parse_schedule_intervals('Mon', log_messages) == () and len(log_messages) == 2    # warned again, cached
+        cache_info = get_schedule_cache_info()
+        assert cache_info.hits == 2 and cache_info.misses == 2 and cache_info.maxsize == g_schedule_cache_size
+
         # ==================== _map_days_to_times
         log_messages = []
         dow_to_times = map_days_to_times(['Mon-Thu 10:00pm-11:30pm', 'Fri-Sat 10:00pm-12:30am'], log_messages)
@@ -409,6 +2124,19 @@ def run_tests():
                 [('0000', '0030')]
             assert dow_to_times[dow] == expected_times and not log_messages
 
+        # ==================== map_schedules_to_intervals
+        log_messages = []
+        intervals = map_schedules_to_intervals(['Mon-Thu 10:00pm-11:30pm', 'Fri-Sat 10:00pm-12:30am'], log_messages)
+        assert intervals == [(get_week_minute('Mon', '2200'), get_week_minute('Mon', '2330')),
+                             (get_week_minute('Tue', '2200'), get_week_minute('Tue', '2330')),
+                             (get_week_minute('Wed', '2200'), get_week_minute('Wed', '2330')),
+                             (get_week_minute('Thu', '2200'), get_week_minute('Thu', '2330')),
+                             (get_week_minute('Fri', '2200'), get_week_minute('Sat', '0030')),   # merged over midnight
+                             (get_week_minute('Sat', '2200'), get_week_minute('Sun', '0030'))] and not log_messages
+
+        intervals = map_schedules_to_intervals(['Sun 10:00 pm - 2:00 am'], log_messages)    # wraps to Monday
+        assert intervals == [(0, 120), (get_week_minute('Sun', '2200'), g_minutes_per_week)]
+
         # ==================== Restaurant.is_open:
         test_times = (
             '0000', '0030', '0100', '0130', '0200', '0230', '0300', '0330', '0400', '0430', '0500', '0530',
@@ -437,6 +2165,470 @@ def run_tests():
         assert [r.name for r in get_open_restaurants(restaurants, 'Mon', '1700')] == ['C']
         assert [r.name for r in get_open_restaurants(restaurants, 'Sat', '0000')] == ['A']
 
+        # ==================== merge_intervals
+        assert merge_intervals([]) == []
+        assert merge_intervals([(5, 10), (0, 3)]) == [(0, 3), (5, 10)]
+        assert merge_intervals([(5, 10), (0, 5)]) == [(0, 10)]     # touching intervals are combined
+        assert merge_intervals([(0, 10), (2, 4), (8, 12)]) == [(0, 12)]
+
+        # ==================== bitsets
+        assert make_bitset([], 10) == 0
+        assert make_bitset([0, 3, 9], 10) == 0b1000001001
+        assert list(iterate_bitset(0)) == []
+        assert list(iterate_bitset(0b1000001001)) == [0, 3, 9]
+
+        # ==================== RestaurantIndex
+        rest_d = Restaurant('D', ['Sun 10:00 pm - 2:00 am'])    # wraps from the end of the week to the beginning
+        rest_e = Restaurant('E', ['Mon-Sun 11 am - 10 pm', 'Sat 5 pm - 11 pm'])    # overlapping schedules
+        restaurants = [rest_a, rest_b, rest_c, rest_d, rest_e, Restaurant('F', ['Mon'])]
+        restaurant_index = RestaurantIndex(restaurants)
+        assert [r.name for r in restaurant_index.get_open_restaurants('Mon', '2100')] == ['A', 'B', 'C', 'E']
+        assert [r.name for r in restaurant_index.get_open_restaurants('Mon', '0130')] == ['D']
+        assert restaurant_index.get_open_positions_at(get_week_minute('Mon', '2100')) == [0, 1, 2, 4]
+        for day in g_days_of_week:
+            for time in test_times[:-1]:
+                for minute in ('00', '29'):
+                    time = time[:2] + minute
+                    assert restaurant_index.get_open_restaurants(day, time) == \
+                           get_open_restaurants(restaurants, day, time)
+        assert RestaurantIndex([]).get_open_restaurants('Mon', '1200') == []
+
+        # ==================== normalize_window
+        assert normalize_window(60, 120) == (60, 120)
+        assert normalize_window(g_minutes_per_week + 60, g_minutes_per_week + 120) == (60, 120)
+        assert normalize_window(g_minutes_per_week - 60, 60) == (g_minutes_per_week - 60, g_minutes_per_week + 60)
+        assert normalize_window(60, 60) == (60, 60 + g_minutes_per_week)     # a whole week
+        assert normalize_window(60, 3 * g_minutes_per_week) == (60, 60 + g_minutes_per_week)
+
+        # ==================== Restaurant.is_open_between
+        assert rest_a.get_closing_week_minute(get_week_minute('Fri', '2300')) == get_week_minute('Sat', '0030')
+        assert rest_a.get_closing_week_minute(get_week_minute('Fri', '0300')) is None
+        assert rest_d.get_closing_week_minute(get_week_minute('Sun', '2300')) == g_minutes_per_week + 120  # into Monday
+        assert Restaurant('24/7', ['Mon-Sun 12 am - 12 pm', 'Mon-Sun 12 pm - 12 am']).get_closing_week_minute(0) == \
+               math.inf
+        assert rest_a.is_open_between(get_week_minute('Fri', '2130'), get_week_minute('Sat', '0030'))
+        assert not rest_a.is_open_between(get_week_minute('Fri', '2130'), get_week_minute('Sat', '0100'))
+        assert not rest_a.is_open_between(get_week_minute('Thu', '2300'), get_week_minute('Fri', '1900'))
+        assert rest_d.is_open_between(get_week_minute('Sun', '2300'), get_week_minute('Mon', '0100'))  # wraps the week
+        assert not rest_d.is_open_between(get_week_minute('Sun', '2300'), get_week_minute('Mon', '0300'))
+
+        # ==================== transitions
+        assert get_transitions([]) == ([], [])
+        assert get_transitions([(0, 120), (600, 700), (9960, g_minutes_per_week)]) == ([600, 9960], [120, 700])
+        assert get_transitions([(0, g_minutes_per_week)]) == ([], [])    # never opens or closes
+        assert get_minutes_until_next([], 10) is None
+        assert get_minutes_until_next([100, 200], 100) == 100
+        assert get_minutes_until_next([100, 200], 250) == g_minutes_per_week - 250 + 100     # wraps to next week
+
+        fri_2300 = datetime(2023, 2, 10, 23, 0)
+        assert minutes_until_close(rest_a, fri_2300) == 90   # Fri 6 pm - Sat 12:30 am
+        assert minutes_until_close(rest_b, fri_2300) is None
+        assert minutes_until_close(rest_d, datetime(2023, 2, 12, 23, 30)) == 150    # Sun 10 pm through Mon 2 am
+        assert minutes_until_close(Restaurant('24/7', ['Mon-Sun 12 am - 12 pm', 'Mon-Sun 12 pm - 12 am']),
+                                   fri_2300) == math.inf
+        assert next_open(rest_a, fri_2300) is fri_2300
+        assert next_open(rest_b, fri_2300) == datetime(2023, 2, 13, 20, 0)     # next Monday, wrapping the week
+        assert next_open(rest_d, datetime(2023, 2, 12, 21, 59, 30)) == datetime(2023, 2, 12, 22, 0)
+        assert next_open(restaurants[5], fri_2300) is None     # F never opens
+        assert [(r.name, close, opening) for r, close, opening in get_next_changes(restaurants[:2], fri_2300)] == \
+               [('A', 90, fri_2300), ('B', None, datetime(2023, 2, 13, 20, 0))]
+
+        # ==================== RestaurantIndex.get_open_restaurants_between
+        assert [r.name for r in restaurant_index.get_open_restaurants_between(get_week_minute('Fri', '2130'),
+                                                                              get_week_minute('Sat', '0030'))] == ['A']
+        assert [r.name for r in restaurant_index.get_open_restaurants_between(get_week_minute('Sun', '2300'),
+                                                                              get_week_minute('Mon', '0100'))] == ['D']
+        for start_week_minute in range(0, g_minutes_per_week, 90):
+            for window_minutes in (1, 30, 45, 150, 24 * 60, g_minutes_per_week):
+                end_week_minute = start_week_minute + window_minutes
+                assert restaurant_index.get_open_restaurants_between(start_week_minute, end_week_minute) == \
+                       get_open_restaurants_between(restaurants, start_week_minute, end_week_minute)
+
+        # ==================== ResultCache
+        result_cache = ResultCache(2)
+        assert result_cache.get('a') is None
+        result_cache.put('a', 1)
+        result_cache.put('b', 2)
+        assert result_cache.get('a') == 1   # now 'b' is the least recently used
+        result_cache.put('c', 3)
+        assert result_cache.get('b') is None and result_cache.get('c') == 3
+        assert result_cache.to_dict() == {'size': 2, 'max_size': 2, 'hits': 2, 'misses': 2, 'hit_rate': 0.5}
+        result_cache.clear()
+        assert result_cache.get('a') is None
+
+        # ==================== RestaurantIndex.get_sorted_results_at
+        unsorted_index = RestaurantIndex([rest_e, rest_c, rest_a, rest_b])
+        names = unsorted_index.get_open_names_at(get_week_minute('Mon', '2100'))
+        assert names == ('A', 'B', 'C', 'E') and unsorted_index.result_cache.misses == 1
+        assert unsorted_index.get_open_names_at(get_week_minute('Mon', '2115')) is names   # same segment, shared
+        assert unsorted_index.result_cache.hits == 1
+        assert [r.name for r in unsorted_index.get_open_restaurants_by_name_at(get_week_minute('Mon', '2100'))] == \
+               ['A', 'B', 'C', 'E']
+        unsorted_index.clear_results()
+        assert unsorted_index.get_open_names_at(get_week_minute('Mon', '2100')) is not names
+        for week_minute in range(0, g_minutes_per_week, 30):
+            assert list(unsorted_index.get_open_names_at(week_minute)) == \
+                   sorted(r.name for r in unsorted_index.get_open_restaurants_at(week_minute))
+
+        # ==================== MetricsRegistry
+        events = []
+        previous_metrics = g_metrics    # set when the tests themselves run with --profile
+        metrics_registry = enable_metrics()
+        metrics_registry.add_listener(lambda name, value: events.append(name))
+        try:
+            parse_schedule_intervals('Mon 4 pm - 5 pm', [])
+            parse_schedule_intervals('Mon', [])
+            get_open_restaurants_at(restaurants, 0)
+            restaurant_index.get_open_restaurants_at(get_week_minute('Mon', '2100'))
+        finally:
+            if previous_metrics is not None:
+                enable_metrics(previous_metrics)
+            else:
+                disable_metrics()
+        parse_schedule_intervals('Mon', [])     # not recorded in this registry any more
+        metrics = metrics_registry.to_dict()
+        assert metrics['counters'] == {'parse.format_mismatches': 1, 'query.restaurants_returned': 4,
+                                       'query.restaurants_scanned': len(restaurants)}
+        assert metrics['histograms']['parse.schedule_seconds']['count'] == 2
+        assert metrics['histograms']['query.scan_seconds']['count'] == 1
+        assert metrics['histograms']['query.index_seconds']['count'] == 1
+        assert events == ['parse.schedule_seconds', 'parse.schedule_seconds', 'parse.format_mismatches',
+                          'query.scan_seconds', 'query.restaurants_scanned', 'query.index_seconds',
+                          'query.restaurants_returned']
+
+        # ==================== RestaurantStore
+        assert not hasattr(rest_a, '__dict__')
+        store = RestaurantStore()
+        for restaurant in restaurants:
+            store.append(restaurant.name, restaurant.schedule_strings)
+        assert len(store) == len(restaurants) and store.names == [r.name for r in restaurants]
+        assert list(store.iterate_intervals()) == list(iterate_intervals(restaurants))
+        assert store.log_messages == {5: restaurants[5].log_messages}
+        for restaurant_id, restaurant in enumerate(restaurants):
+            assert store[restaurant_id].name == restaurant.name
+            assert store[restaurant_id].open_intervals == restaurant.open_intervals
+        assert store[-1].name == 'F' and store[-1].open_intervals == []
+        assert store[0].schedule_strings is None and str(store[0]).startswith('Restaurant "A"\nParsed schedule:\n')
+        store_index = RestaurantIndex(store)
+        assert store_index.restaurants is store
+        for week_minute in range(0, g_minutes_per_week, 30):
+            assert [r.name for r in store_index.get_open_restaurants_at(week_minute)] == \
+                   [r.name for r in restaurant_index.get_open_restaurants_at(week_minute)]
+
+        # ==================== iterate_json_array
+        for chunk_size in (1, 3, g_read_chunk_size):
+            assert list(iterate_json_array(io.StringIO(' [ ] '), chunk_size)) == []
+            assert list(iterate_json_array(io.StringIO('[12345, "a,]b", {"c": [1, 2]}]'), chunk_size)) == \
+                   [12345, 'a,]b', {'c': [1, 2]}]
+            assert list(iterate_json_array(io.StringIO('[1e5]'), chunk_size)) == [1e5]
+            assert list(iterate_json_array(io.StringIO('[1.5, -2E-3]'), chunk_size)) == [1.5, -2e-3]
+            for bad_json in ('', '{}', '[1, 2', '[1 2]', '[1,, 2]', '[{"a": 1]'):
+                try:
+                    list(iterate_json_array(io.StringIO(bad_json), chunk_size))
+                    assert False, f'expected a parsing error for {bad_json!r}'
+                except ValueError:  # json.JSONDecodeError is a ValueError
+                    pass
+
+        # ==================== iterate_restaurant_records
+        records = [{'name': 'A', 'times': ['Mon 9 am - 5 pm']}, {'name': 'B', 'times': []}]
+        json_lines = '\n'.join(json.dumps(record) for record in records) + '\n\n'
+        assert list(iterate_restaurant_records(io.StringIO(json_lines), True)) == records
+        assert list(iterate_restaurant_records(io.StringIO(json.dumps(records)), False)) == records
+
+        # ==================== snapshots
+        with tempfile.TemporaryDirectory() as temp_folder_path:
+            source_file_path = os.path.join(temp_folder_path, 'restaurants.json')
+            snapshot_file_path = os.path.join(temp_folder_path, 'restaurants.snapshot')
+            with open(source_file_path, 'w') as source_file:
+                json.dump([{'name': r.name, 'times': r.schedule_strings} for r in restaurants], source_file)
+            assert read_snapshot(snapshot_file_path, source_file_path) is None  # not compiled yet
+
+            write_snapshot(snapshot_file_path, RestaurantIndex(stream_restaurant_store(source_file_path)),
+                           source_file_path)
+            snapshot_index = read_snapshot(snapshot_file_path, source_file_path)
+            assert list(snapshot_index.boundaries) == restaurant_index.boundaries
+            assert list(snapshot_index.segment_bits) == restaurant_index.segment_bits
+            assert [snapshot_index.restaurants[i].name for i in range(len(restaurants))] == [r.name for r in restaurants]
+            assert snapshot_index.restaurants.log_messages == {5: restaurants[5].log_messages}
+            for week_minute in range(0, g_minutes_per_week, 30):
+                assert [r.name for r in snapshot_index.get_open_restaurants_at(week_minute)] == \
+                       [r.name for r in restaurant_index.get_open_restaurants_at(week_minute)]
+
+            source_stat = os.stat(source_file_path)
+            os.utime(source_file_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns + 10 ** 9))
+            assert read_snapshot(snapshot_file_path, source_file_path) is not None     # touched, but same contents
+            with open(source_file_path, 'w') as source_file:
+                json.dump([{'name': 'Z', 'times': []}], source_file)
+            assert read_snapshot(snapshot_file_path, source_file_path) is None     # stale
+            stale_index = load_restaurant_index(source_file_path, snapshot_file_path)  # falls back to the JSON file
+            assert [stale_index.restaurants[i].name for i in range(len(stale_index.restaurants))] == ['Z']
+            del snapshot_index  # release the memory mapping before the folder is removed
+
+        # ==================== LatencyHistogram
+        histogram = LatencyHistogram((0.001, 0.01))
+        assert histogram.get_percentile(0.5) == 0.0
+        for seconds in (0.0005, 0.0005, 0.005, 0.5):
+            histogram.record(seconds)
+        assert histogram.bucket_counts == [2, 1, 1] and histogram.count == 4
+        assert histogram.get_percentile(0.5) == 0.001 and histogram.get_percentile(0.75) == 0.01
+        assert histogram.get_percentile(0.99) == 0.5    # over the largest bound: the max
+
+        # ==================== RestaurantService
+        service = RestaurantService(ShardedRestaurantIndex.from_index(restaurant_index))
+        status, response = service.handle_request('GET', '/open?at=2023-02-06T21:00', b'')
+        assert status == 200 and response['names'] == ['A', 'B', 'C', 'E'] and response['dow'] == 'Mon' and \
+               response['time'] == '2100' and response['count'] == 4
+        status, response = service.handle_request('POST', '/open/batch',
+                                                  b'{"at": ["2023-02-06 1:30 am", "2023-02-11 00:00"]}')
+        assert status == 200 and [result['names'] for result in response] == [['D'], ['A']]
+        status, response = service.handle_request('GET', '/open?at=2023-02-11T23:00&until=2023-02-12T00:30', b'')
+        assert status == 200 and response['names'] == ['A'] and response['until'] == '2023-02-12T00:30'
+        assert service.handle_request('GET', '/open?at=2023-02-11T23:00&until=2023-02-11T22:00', b'')[0] == 400
+        assert service.handle_request('GET', '/open', b'')[0] == 400
+        assert service.handle_request('GET', '/open?at=bogus', b'')[0] == 400
+        assert service.handle_request('POST', '/open/batch', b'{"at": 5}')[0] == 400
+        assert service.handle_request('POST', '/open/batch', b'{"at": [1]}')[0] == 400
+        assert service.handle_request('POST', '/open/batch', b'{"at": [null]}')[0] == 400
+        assert service.handle_request('POST', '/open', b'')[0] == 405
+        assert service.handle_request('GET', '/closed', b'')[0] == 404
+        status, response = service.handle_request('GET', '/metrics', b'')
+        assert status == 200 and response['restaurants'] == len(restaurants) and \
+               response['latency']['/open']['count'] == 5 and response['latency']['/open/batch']['count'] == 4
+
+        import asyncio
+
+        async def query_service(restaurant_service, request_bytes):
+            server = await asyncio.start_server(restaurant_service.handle_connection, '127.0.0.1', 0)
+            async with server:
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                writer.write(request_bytes)
+                response_bytes = await reader.read()
+                writer.close()
+            return response_bytes
+
+        response_bytes = asyncio.run(query_service(
+            service, b'GET /open?at=2023-02-06T01:30 HTTP/1.1\r\nHost: test\r\n\r\n'
+                     b'GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n'))
+        assert response_bytes.startswith(b'HTTP/1.1 200 OK\r\n') and response_bytes.count(b'HTTP/1.1 200 OK') == 2
+        assert b'"names": ["D"]' in response_bytes
+
+        broken_service = RestaurantService(None)    # every /open request fails inside the handler
+        with contextlib.redirect_stderr(io.StringIO()):
+            response_bytes = asyncio.run(query_service(
+                broken_service, b'GET /open?at=2023-02-06T01:30 HTTP/1.1\r\n\r\n'
+                                b'GET /open?at=2023-02-06T01:30 HTTP/1.1\r\nConnection: close\r\n\r\n'))
+        assert response_bytes.count(b'HTTP/1.1 500 Internal Server Error\r\n') == 2     # answered, and kept serving
+
+        # ==================== RestaurantIndexReloader
+        with tempfile.TemporaryDirectory() as temp_folder_path:
+            source_file_path = os.path.join(temp_folder_path, 'restaurants.json')
+            records = [{'name': r.name, 'times': r.schedule_strings} for r in restaurants]
+            with open(source_file_path, 'w') as source_file:
+                json.dump(records, source_file)
+            reloader = RestaurantIndexReloader(source_file_path, poll_seconds=0.01)
+            first_index = reloader.restaurant_index
+            assert isinstance(first_index.restaurants, RestaurantStore)
+            assert reloader.reload_count == 1 and reloader.parsed_count == len(restaurants)
+            assert not reloader.check_for_changes()
+
+            def rewrite_source(changed_records, mtime_offset):
+                with open(source_file_path, 'w') as source_file:
+                    json.dump(changed_records, source_file)
+                source_stat = os.stat(source_file_path)
+                os.utime(source_file_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns + mtime_offset))
+
+            records[1] = {'name': 'B', 'times': ['Tue 8:00 pm - 10:00 pm']}    # B moves from Monday to Tuesday
+            rewrite_source(records, 10 ** 9)
+            assert reloader.check_for_changes() and reloader.reload_count == 2 and reloader.parsed_count == 1
+            assert reloader.restaurant_index is not first_index
+            assert reloader.restaurant_store.get_open_intervals(0) == first_index.restaurants.get_open_intervals(0)
+            assert [r.name for r in reloader.restaurant_index.get_open_restaurants('Mon', '2100')] == ['A', 'C', 'E']
+            assert [r.name for r in first_index.get_open_restaurants('Mon', '2100')] == ['A', 'B', 'C', 'E']
+
+            with open(source_file_path, 'w') as source_file:
+                source_file.write('[{"name": ')   # half-written: keep the current index
+            with contextlib.redirect_stderr(io.StringIO()) as error_output:
+                assert not reloader.check_for_changes() and reloader.reload_count == 2
+            assert error_output.getvalue().startswith('Warning: Could not reload')
+
+            reloader.start()    # the worker thread picks up the next change by itself
+            rewrite_source(records[:2], 2 * 10 ** 9)
+            for _ in range(500):
+                if reloader.reload_count == 3:
+                    break
+                reloader.stop_event.wait(0.01)
+            reloader.stop()
+            assert reloader.reload_count == 3 and len(reloader.restaurant_index.restaurants) == 2
+
+        # ==================== benchmark generator
+        assert format_clock_time(0) == '12 am' and format_clock_time(12 * 60 + 30) == '12:30 pm'
+        assert format_clock_time(g_minutes_per_day + 90) == '1:30 am'   # past midnight
+        rng = random.Random(1)
+        log_messages = []
+        wrapped_count = two_range_count = 0
+        for _ in range(500):
+            schedule_string = generate_schedule_string(rng)
+            intervals = parse_schedule_intervals(schedule_string, log_messages)
+            assert intervals and not log_messages, schedule_string
+            wrapped_count += any(start % g_minutes_per_day == 0 for start, end in intervals)
+            two_range_count += ',' in schedule_string
+        assert wrapped_count and two_range_count
+
+        result = run_benchmark(50, query_count=20)
+        assert result['venues'] == 50 and result['queries'] == 20 and result['query_p50_ms'] <= result['query_p99_ms']
+
+        # ==================== parallel_restaurant_store
+        with tempfile.TemporaryDirectory() as temp_folder_path:
+            source_file_path = os.path.join(temp_folder_path, 'restaurants.json')
+            with open(source_file_path, 'w') as source_file:
+                json.dump([{'name': r.name, 'times': r.schedule_strings,
+                            'timezone': ('America/Denver', None, None, 'Nowhere/Land')[i % 4]}
+                           for i, r in enumerate(restaurants * 3)], source_file)
+            serial_warnings = []
+            serial_store = stream_restaurant_store(source_file_path, serial_warnings.append)
+            parallel_warnings = []
+            parallel_store = parallel_restaurant_store(source_file_path, parallel_warnings.append, workers=2,
+                                                       chunk_records=4)
+            assert parallel_store.names == serial_store.names and \
+                   parallel_store.restaurant_ids == serial_store.restaurant_ids and \
+                   parallel_store.starts == serial_store.starts and parallel_store.ends == serial_store.ends and \
+                   parallel_store.log_messages == serial_store.log_messages and \
+                   parallel_store.timezones == serial_store.timezones and len(parallel_store.timezones) == 5
+            assert parallel_warnings == serial_warnings and len(parallel_warnings) == 7
+
+        # ==================== get_open_restaurants_for_datetimes
+        date_times = [datetime(2023, 2, 6, 21, 0), datetime(2023, 2, 6, 1, 30), datetime(2023, 2, 13, 21, 15),
+                      datetime(2023, 2, 11, 0, 0)]
+        results = get_open_restaurants_for_datetimes(restaurant_index, date_times)
+        assert [[r.name for r in result] for result in results] == \
+               [['A', 'B', 'C', 'E'], ['D'], ['A', 'B', 'C', 'E'], ['A']]
+        assert results[0] is results[2]     # both times fall in the same segment, decoded once
+        for date_time, result in zip(date_times, results):
+            assert list(result) == restaurant_index.get_open_restaurants(*transform_datetime_to_dow_and_time(date_time))
+        assert get_open_restaurants_for_datetimes(restaurant_index, []) == []
+        names_results = get_open_names_for_datetimes(RestaurantIndex(store), date_times)
+        assert [list(names) for names in names_results] == [sorted(r.name for r in result) for result in results]
+        assert names_results[0] is names_results[2]
+        assert get_open_names_for_datetimes(restaurant_index, []) == []
+
+        # ==================== export
+        assert list(iterate_day_intervals([(1320, 1560), (10000, g_minutes_per_week)])) == \
+               [(0, 1320, 1440), (1, 0, 120), (6, 1360, 1440)]
+        assert get_export_rows(rest_d) == [('D', '', 'Mon', 0, 120, 'Sun 10:00 pm - 2:00 am', ''),
+                                           ('D', '', 'Sun', 1320, 1440, 'Sun 10:00 pm - 2:00 am', '')]
+        assert get_export_rows(rest_e)[5] == ('E', '', 'Sat', 660, 1380, 'Mon-Sun 11 am - 10 pm; Sat 5 pm - 11 pm', '')
+        assert get_export_rows(restaurants[5]) == [('F', '', '', '', '', 'Mon', restaurants[5].log_messages[0])]
+        assert get_export_rows(store[3]) == [('D', '', 'Mon', 0, 120, '', ''), ('D', '', 'Sun', 1320, 1440, '', '')]
+        with tempfile.TemporaryDirectory() as temp_folder_path:
+            source_file_path = os.path.join(temp_folder_path, 'restaurants.json')
+            with open(source_file_path, 'w') as source_file:
+                json.dump([{'name': r.name, 'times': r.schedule_strings} for r in restaurants], source_file)
+            export_file = io.StringIO(newline='')
+            assert export_restaurant_intervals(source_file_path, export_file) == len(restaurants)
+            export_rows = list(csv.reader(io.StringIO(export_file.getvalue(), newline='')))
+            assert export_rows[0] == list(g_export_columns)
+            assert export_rows[1:] == [[str(value) for value in row] for r in restaurants for row in get_export_rows(r)]
+
+        # ==================== time zones and ShardedRestaurantIndex
+        rest_denver = Restaurant('Denver', ['Mon-Fri 9 am - 5 pm'], 'America/Denver')
+        rest_tokyo = Restaurant('Tokyo', ['Mon-Sun 9 am - 5 pm'], 'Asia/Tokyo')
+        assert rest_denver.timezone == 'America/Denver' and not rest_denver.log_messages
+        assert get_export_rows(rest_denver)[0] == \
+               ('Denver', 'America/Denver', 'Mon', 540, 1020, 'Mon-Fri 9 am - 5 pm', '')
+        rest_unknown = Restaurant('Unknown', ['Mon 9 am - 5 pm'], 'Nowhere/Land')
+        assert rest_unknown.timezone is None and rest_unknown.log_messages == \
+               ['Warning: Unknown time zone "Nowhere/Land". Its times are taken as local to each query.']
+
+        mon_1700_utc = datetime.fromisoformat('2023-02-06T17:00+00:00')    # Mon 10 am in Denver, Tue 2 am in Tokyo
+        mon_1000 = datetime(2023, 2, 6, 10, 0)     # naive, so local to every restaurant
+        assert minutes_until_close(rest_denver, mon_1700_utc) == 7 * 60
+        assert next_open(rest_tokyo, mon_1700_utc) == mon_1700_utc + timedelta(hours=7)
+        assert [(r.name, close) for r, close, opening in get_next_changes([rest_e, rest_denver], mon_1700_utc)] == \
+               [('E', 5 * 60), ('Denver', 7 * 60)]
+
+        zoned_restaurants = restaurants + [rest_denver, rest_tokyo]
+        sharded_index = ShardedRestaurantIndex(zoned_restaurants)
+        assert [shard.timezone for shard in sharded_index.shards] == [None, 'America/Denver', 'Asia/Tokyo']
+        assert sharded_index.get_shard_week_minutes(mon_1700_utc) == [17 * 60, 10 * 60, g_minutes_per_day + 2 * 60]
+        assert sharded_index.get_open_names_at(mon_1700_utc) == ('C', 'Denver', 'E')
+        assert [r.name for r in sharded_index.get_open_restaurants_at(mon_1700_utc)] == ['C', 'E', 'Denver']
+        assert [r.name for r in sharded_index.get_open_restaurants_by_name_at(mon_1700_utc)] == ['C', 'Denver', 'E']
+        assert sharded_index.get_open_names_at(mon_1000) == ('Denver', 'Tokyo')
+        assert [r.name for r in sharded_index.get_open_restaurants_between(
+            datetime.fromisoformat('2023-02-06T16:00+00:00'), datetime.fromisoformat('2023-02-06T18:00+00:00'))] == \
+               ['C', 'E', 'Denver']
+        for end_date_time in (mon_1700_utc, mon_1700_utc + timedelta(seconds=59), mon_1700_utc - timedelta(hours=1)):
+            try:
+                sharded_index.get_open_restaurants_between(mon_1700_utc, end_date_time)
+                assert False
+            except ValueError:
+                pass
+        # across a DST change, waits and windows follow the restaurant's wall clock
+        dst_start_utc = datetime.fromisoformat('2023-03-12T08:00+00:00')    # Sun 1 am MST, an hour before DST starts
+        assert next_open(rest_denver, dst_start_utc) == datetime.fromisoformat('2023-03-13T15:00+00:00')  # 9 am MDT
+        assert get_next_changes([rest_denver], dst_start_utc)[0][2] == datetime.fromisoformat('2023-03-13T15:00+00:00')
+        rest_late_denver = Restaurant('Late Denver', ['Sat 10 pm - 2 am'], 'America/Denver')
+        dst_end_index = ShardedRestaurantIndex([rest_late_denver])
+        assert [r.name for r in dst_end_index.get_open_restaurants_between(    # 12 am MDT to 2 am MST: 3 hours elapsed
+            datetime.fromisoformat('2023-11-05T06:00+00:00'), datetime.fromisoformat('2023-11-05T09:00+00:00'))] == \
+               ['Late Denver']
+        assert dst_end_index.get_open_restaurants_between(     # 12 am to 3 am MST: past closing
+            datetime.fromisoformat('2023-11-05T06:00+00:00'), datetime.fromisoformat('2023-11-05T10:00+00:00')) == []
+        results = get_open_restaurants_for_datetimes(sharded_index, [mon_1700_utc, mon_1000])
+        assert [sorted(r.name for r in result) for result in results] == [['C', 'Denver', 'E'], ['Denver', 'Tokyo']]
+        assert get_open_names_for_datetimes(sharded_index, [mon_1700_utc, mon_1000]) == \
+               [('C', 'Denver', 'E'), ('Denver', 'Tokyo')]
+        for day in g_days_of_week:
+            for time in ('0130', '1000', '2100'):
+                assert sharded_index.get_open_restaurants(day, time) == \
+                       get_open_restaurants(zoned_restaurants, day, time)
+                assert ShardedRestaurantIndex(restaurants).get_open_restaurants(day, time) == \
+                       restaurant_index.get_open_restaurants(day, time)
+        assert [sharded_index.get_name(position) for position in range(len(zoned_restaurants))] == \
+               [r.name for r in zoned_restaurants]
+        single_shard_index = ShardedRestaurantIndex.from_index(restaurant_index)
+        assert len(single_shard_index.shards) == 1 and single_shard_index.shards[0].restaurant_index is restaurant_index
+
+        zoned_store = RestaurantStore()
+        for r in zoned_restaurants:
+            zoned_store.append(r.name, r.schedule_strings, r.timezone)
+        assert zoned_store.timezones == {6: 'America/Denver', 7: 'Asia/Tokyo'}
+        assert zoned_store[6].timezone == 'America/Denver' and zoned_store[0].timezone is None
+        store_sharded_index = ShardedRestaurantIndex(zoned_store)
+        assert store_sharded_index.get_name(6) == 'Denver'
+        status, response = RestaurantService(store_sharded_index).handle_request(
+            'GET', '/open?at=2023-02-06T16:00%2B00:00&until=2023-02-06T18:00%2B00:00', b'')
+        assert status == 200 and response['names'] == ['C', 'Denver', 'E']
+        denver_selection = store_sharded_index.shards[1].restaurant_index.restaurants
+        assert isinstance(denver_selection, RestaurantStoreSelection) and denver_selection.store is zoned_store
+        assert len(denver_selection) == 1 and denver_selection.get_name(0) == 'Denver' and \
+               denver_selection[0].open_intervals == rest_denver.open_intervals
+        assert list(denver_selection.iterate_intervals()) == \
+               [(0, start, end) for start, end in rest_denver.open_intervals]
+        for hours in range(0, 7 * 24, 5):
+            date_time = mon_1700_utc + timedelta(hours=hours)
+            assert [r.name for r in store_sharded_index.get_open_restaurants_at(date_time)] == \
+                   [r.name for r in sharded_index.get_open_restaurants_at(date_time)]
+
+        with tempfile.TemporaryDirectory() as temp_folder_path:
+            source_file_path = os.path.join(temp_folder_path, 'restaurants.json')
+            snapshot_file_path = os.path.join(temp_folder_path, 'restaurants.snapshot')
+            with open(source_file_path, 'w') as source_file:
+                json.dump([{'name': r.name, 'times': r.schedule_strings, 'timezone': r.timezone}
+                           for r in zoned_restaurants], source_file)
+            write_snapshot(snapshot_file_path, RestaurantIndex(stream_restaurant_store(source_file_path)),
+                           source_file_path)
+            snapshot_index = read_snapshot(snapshot_file_path, source_file_path)
+            assert snapshot_index.restaurants.timezones == zoned_store.timezones
+            assert ShardedRestaurantIndex.from_index(snapshot_index).get_open_names_at(mon_1700_utc) == \
+                   ('C', 'Denver', 'E')
+            del snapshot_index  # release the memory mapping before the folder is removed
+
+        service = RestaurantService(sharded_index)
+        status, response = service.handle_request('GET', '/open?at=2023-02-06T17:00%2B00:00', b'')
+        assert status == 200 and response['names'] == ['C', 'Denver', 'E'] and response['time'] == '1700'
+        assert service.handle_request('GET', '/metrics', b'')[1]['shards'] == 3
+
     except AssertionError:
         print('========== A test failed. Review the errors and fix the failing test.')
         raise
@@ -446,21 +2638,140 @@ def run_tests():
 def load_and_dump_restaurants():
     print(f'Reading restaurant file "{g_restaurants_file_path}"...')
     all_restaurants = read_restaurant_schedules(g_restaurants_file_path)
-    print(f'\t{len(all_restaurants)} restaurants loaded.')
+    cache_info = get_schedule_cache_info()
+    print(f'\t{len(all_restaurants)} restaurants loaded ({cache_info.hits} schedule strings parsed from cache, '
+          f'{cache_info.misses} parsed new).')
 
     print('Dumping restaurant results...')
     for restaurant in all_restaurants:
         print(f'{restaurant}')
 
 
+def export_restaurants(export_file_path):
+    print(f'Reading restaurant file "{g_restaurants_file_path}"...')
+    with open(export_file_path, 'w', newline='', encoding='utf-8', buffering=g_write_buffer_size) as export_file:
+        restaurant_count = export_restaurant_intervals(g_restaurants_file_path, export_file)
+    print(f'\t{restaurant_count} restaurants exported to "{export_file_path}".')
+    return g_ERR_OK
+
+
+def run_batch(datetimes_file_path):
+    print(f'Reading restaurant file "{g_restaurants_file_path}"...')
+    restaurant_index = ShardedRestaurantIndex.from_index(
+        load_restaurant_index(g_restaurants_file_path, g_snapshot_file_path, write_parse_warning_to_stderr))
+    print(f'\t{len(restaurant_index.restaurants)} restaurants loaded.')
+
+    print(f'Reading date/time file "{datetimes_file_path}"...')
+    datetime_objects = read_datetimes(datetimes_file_path)
+    print(f'\t{len(datetime_objects)} dates and times loaded.')
+
+    results = get_open_names_for_datetimes(restaurant_index, datetime_objects)
+    show_batch_results(datetime_objects, results)
+    return g_ERR_OK
+
+
+def compile_snapshot(workers):
+    print(f'Reading restaurant file "{g_restaurants_file_path}"...')
+    if workers > 1:
+        store = parallel_restaurant_store(g_restaurants_file_path, print_parse_warning, workers)
+    else:
+        store = stream_restaurant_store(g_restaurants_file_path, print_parse_warning)
+    print(f'\t{len(store)} restaurants loaded.')
+
+    print(f'Writing compiled snapshot "{g_snapshot_file_path}"...')
+    write_snapshot(g_snapshot_file_path, RestaurantIndex(store), g_restaurants_file_path)
+    print(f'\t{os.path.getsize(g_snapshot_file_path)} bytes written.')
+    return g_ERR_OK
+
+
+def serve(port):
+    print(f'Reading restaurant file "{g_restaurants_file_path}"...')
+    restaurant_index = ShardedRestaurantIndex.from_index(
+        load_restaurant_index(g_restaurants_file_path, g_snapshot_file_path, print_parse_warning))
+    print(f'\t{len(restaurant_index.restaurants)} restaurants loaded.')
+
+    reloader = RestaurantIndexReloader(g_restaurants_file_path, restaurant_index,
+                                       warning_sink=write_parse_warning_to_stderr)
+    reloader.start()
+    import asyncio  # slow to import, so only in this mode
+    try:
+        asyncio.run(run_service(RestaurantService(restaurant_index, reloader), g_serve_host, port))
+    except KeyboardInterrupt:
+        pass
+    reloader.stop()
+    return g_ERR_OK
+
+
+def run_benchmarks(venue_counts):
+    # peak RSS only grows over the life of the process, so sizes run smallest first
+    results = []
+    for venue_count in sorted(venue_counts):
+        print(f'Benchmarking {venue_count} synthetic venues...')
+        result = run_benchmark(venue_count)
+        peak_rss = f'{result["peak_rss_bytes"] / 2 ** 20:.0f} MiB' if result['peak_rss_bytes'] else 'unknown'
+        print(f'\tparse: {result["venues_per_second"]:.0f} venues/s, {result["schedule_strings_per_second"]:.0f} '
+              f'schedules/s; index: {result["index_seconds"]:.3f} s; query p50 {result["query_p50_ms"]:.3f} ms, '
+              f'p99 {result["query_p99_ms"]:.3f} ms; peak RSS {peak_rss}')
+        results.append(result)
+
+    bench_output_file_path = os.path.join(os.getcwd(), g_bench_output_filename)
+    with open(bench_output_file_path, 'w') as bench_output_file:
+        json.dump({'python': sys.version, 'platform': sys.platform, 'seed': g_bench_seed, 'results': results},
+                  bench_output_file, indent=2)
+    print(f'Results written to "{bench_output_file_path}".')
+    return g_ERR_OK
+
+
+def run_mode(function, *args):
+    return run_profiled(function, *args) if g_profile else function(*args)
+
+
 if __name__ == '__main__':
-    # Run unit tests, data dump, or the program (mutually exclusive)
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()  # lets the worker processes of a parallel load start in a frozen executable
+
+    # --profile (with any mode) also writes a cProfile and metrics report
+    g_profile = '--profile' in sys.argv
+    if g_profile:
+        sys.argv.remove('--profile')
+
+    # Run unit tests, data dump or export, batch queries, snapshot compilation, benchmarks, the query service, or the
+    # program (mutually exclusive)
     if len(sys.argv) > 1 and sys.argv[1] == 'test':
-        run_tests()
+        run_mode(run_tests)
         sys.exit(g_ERR_OK)
 
     if len(sys.argv) > 1 and sys.argv[1] == 'dump':
-        load_and_dump_restaurants()
+        run_mode(load_and_dump_restaurants)
         sys.exit(g_ERR_OK)
 
-    sys.exit(main())
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        sys.exit(run_mode(export_restaurants,
+                          sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.getcwd(), g_export_filename)))
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        if len(sys.argv) < 3:
+            print('Usage: FindRestaurants.py batch <file with one date and time per line>')
+            sys.exit(g_ERR_BAD_ARGS)
+        sys.exit(run_mode(run_batch, sys.argv[2]))
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'compile':
+        if len(sys.argv) > 2 and not sys.argv[2].isdigit():
+            print('Usage: FindRestaurants.py compile [number of worker processes]')
+            sys.exit(g_ERR_BAD_ARGS)
+        sys.exit(run_mode(compile_snapshot, int(sys.argv[2]) if len(sys.argv) > 2 else 1))
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        if not all(arg.isdigit() and int(arg) > 0 for arg in sys.argv[2:]):
+            print('Usage: FindRestaurants.py bench [venue count ...]')
+            sys.exit(g_ERR_BAD_ARGS)
+        sys.exit(run_mode(run_benchmarks, [int(arg) for arg in sys.argv[2:]] or g_bench_venue_counts))
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        if len(sys.argv) > 2 and not sys.argv[2].isdigit():
+            print('Usage: FindRestaurants.py serve [port]')
+            sys.exit(g_ERR_BAD_ARGS)
+        sys.exit(run_mode(serve, int(sys.argv[2]) if len(sys.argv) > 2 else g_serve_port))
+
+    sys.exit(run_mode(main))